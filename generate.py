@@ -8,16 +8,278 @@
 
 import torch
 from fairseq import checkpoint_utils, options, progress_bar, tasks, utils
+from mdl import PhaseTimer, WindowProfiler, autocast, checkpoint_sha1, compile_forward, set_thread_counts, wait_for_checkpoint
+from time import perf_counter
+from fairseq.data import LanguagePairDataset, data_utils
+import collections
+import hashlib
 import json
+import math
 import os
+import pathlib
+import queue
+import shutil
+import sys
+import threading
+import numpy as np
 
-from time import sleep
 # from glob import glob
 
-# there are some timing issues when loading the initial checkpoint
-# we'll allow up to 10 retries before exiting
-MAX_RELOAD_TRIES = 10
-WAIT_BETWEEN_RELOAD_TRIES = 120/MAX_RELOAD_TRIES # wait up to 2 minutes total
+class GreedyGenerator:
+    """Greedy decoding of a single fairseq encoder-decoder model (--fast-greedy), a drop-in for `SequenceGenerator`
+    with --beam=1. The decoder runs on its incremental state and the sequences that reached EOS are dropped from
+    the batch. Candidates are ranked as by the beam search with a single beam (same cumulative scores, pad/unk/min-len
+    handling and forced EOS at the maximum length), so the predictions are the same."""
+
+    def __init__(self, tgt_dict, args):
+        self.pad = tgt_dict.pad()
+        self.unk = tgt_dict.unk()
+        self.eos = tgt_dict.eos()
+        self.vocab_size = len(tgt_dict)
+        self.max_len_a = args.max_len_a
+        self.max_len_b = args.max_len_b
+        self.min_len = args.min_len
+        self.unk_penalty = args.unkpen
+        self.len_penalty = args.lenpen
+        self.temperature = args.temperature
+
+    @torch.no_grad()
+    def generate(self, models, sample, prefix_tokens=None, **kwargs):
+        assert len(models) == 1, '--fast-greedy does not support ensembles'
+        assert prefix_tokens is None, '--fast-greedy does not support prefix tokens'
+        model = models[0]
+        model.eval()
+
+        encoder_input = {k: v for k, v in sample['net_input'].items() if k != 'prev_output_tokens'}
+        src_tokens = encoder_input['src_tokens']
+        bsz, src_len = src_tokens.size()
+        max_len = min(int(self.max_len_a * src_len + self.max_len_b), model.max_decoder_positions() - 1)
+
+        encoder_out = model.encoder(**encoder_input)
+        incremental_state = {}
+
+        tokens = src_tokens.new_full((bsz, max_len + 2), self.pad)
+        tokens[:, 0] = self.eos
+        scores = None # cumulative scores, (bsz, max_len + 1)
+        lengths = src_tokens.new_full((bsz,), max_len + 1)
+        # rows of the sequences that are still being decoded
+        active = torch.arange(bsz, device=src_tokens.device)
+
+        for step in range(max_len + 1):
+            decoder_out = list(model.decoder(tokens[active, :step + 1], encoder_out, incremental_state=incremental_state))
+            decoder_out[0] = decoder_out[0][:, -1:, :]
+            if self.temperature != 1.:
+                decoder_out[0].div_(self.temperature)
+            lprobs = model.get_normalized_probs(decoder_out, log_probs=True)[:, -1, :]
+            if scores is None:
+                scores = lprobs.new_zeros((bsz, max_len + 1))
+            if torch.isnan(lprobs).any():
+                # SequenceGenerator fails on these as well, the batch gets skipped
+                raise AssertionError('nan in the decoder output')
+
+            lprobs[:, self.pad] = -math.inf
+            lprobs[:, self.unk] -= self.unk_penalty
+            if step >= max_len:
+                lprobs[:, :self.eos] = -math.inf
+                lprobs[:, self.eos + 1:] = -math.inf
+            if step < self.min_len:
+                lprobs[:, self.eos] = -math.inf
+            if step > 0:
+                lprobs.add_(scores[active, step - 1].unsqueeze(-1))
+
+            # same top-k as the beam search, which takes the best candidate (finalized if it is EOS)
+            cand_scores, cand_indices = lprobs.topk(min(2, self.vocab_size - 1))
+            tokens[active, step + 1] = cand_indices[:, 0]
+            scores[active, step] = cand_scores[:, 0]
+
+            finished = cand_indices[:, 0].eq(self.eos)
+            if finished.any():
+                lengths[active[finished]] = step + 1
+                remaining = (~finished).nonzero().squeeze(-1)
+                if remaining.numel() == 0:
+                    break
+                active = active[remaining]
+                model.decoder.reorder_incremental_state(incremental_state, remaining)
+                encoder_out = model.encoder.reorder_encoder_out(encoder_out, remaining)
+
+        hypos = []
+        for i, length in enumerate(lengths.tolist()):
+            positional_scores = scores[i, :length].clone()
+            positional_scores[1:] -= scores[i, :length - 1]
+            hypos.append([dict(
+                tokens=tokens[i, 1:length + 1],
+                score=scores[i, length - 1].item() / length ** self.len_penalty,
+                attention=None,
+                alignment=None,
+                positional_scores=positional_scores,
+            )])
+        return hypos
+
+
+class PredictionWriter:
+    """Writes the predictions of a batch as json lines: the tokens are detokenized through id -> token lookup
+    tables and the lines of the batch are serialized and written at once (and echoed to stdout with
+    --echo-predictions). With `background` (--async-output), this runs in a writer thread, overlapping
+    with the inference of the next batches."""
+
+    def __init__(self, out_file, src_dict, tgt_dict, remove_bpe, echo=False, background=False):
+        self.out_file = out_file
+        self.src_symbols = list(src_dict.symbols) if src_dict is not None else None
+        self.tgt_symbols = list(tgt_dict.symbols)
+        # as dropped by Dictionary.string (eos, bos) and utils.strip_pad
+        self.special = {tgt_dict.pad(), tgt_dict.eos(), tgt_dict.bos()}
+        self.remove_bpe = remove_bpe
+        self.echo = echo
+        self.queue = self.thread = self.error = None
+        if background:
+            # bounded, so that a slow disk does not let the pending batches pile up in memory
+            self.queue = queue.Queue(maxsize=16)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def put(self, src_tokens, hypo_tokens):
+        """Queue (or write) the sources and predictions of a batch, given as (padded) cpu tensors."""
+        if self.queue is None:
+            self._write(src_tokens, hypo_tokens)
+        else:
+            self.queue.put((src_tokens, hypo_tokens))
+
+    def close(self):
+        """Wait until all the predictions are written."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        self.out_file.flush()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    # raised in the main thread by `close`, the remaining batches are drained
+                    self.error = e
+
+    def _string(self, symbols, ids):
+        sentence = ' '.join(symbols[i] for i in ids if i not in self.special)
+        return data_utils.process_bpe_symbol(sentence, self.remove_bpe)
+
+    def _write(self, src_tokens, hypo_tokens):
+        lines = []
+        for src_ids, hypo_ids in zip(src_tokens.tolist(), hypo_tokens.tolist()):
+            src_str = self._string(self.src_symbols, src_ids) if self.src_symbols is not None else ""
+            hypo_str = self._string(self.tgt_symbols, hypo_ids)
+            result = dict(src=src_str, pred=hypo_str, src_len=len(src_str.split()), pred_len=len(hypo_str.split()))
+            lines.append(json.dumps(result, ensure_ascii=False))
+        text = '\n'.join(lines) + '\n'
+        self.out_file.write(text)
+        if self.echo:
+            sys.stdout.write(text)
+
+
+class GenerationCache:
+    """Content-addressed store of generated-<subset>.json files (--gen-cache-dir), keyed by a hash of the model weights,
+    the data and the decoding args (see `generation_cache_key`). It is bounded to `max_bytes` by evicting the least
+    recently used entries, and can be shared by concurrent jobs: entries are written atomically and a missing entry
+    (e.g. evicted by another job) is a miss."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return self.directory / f'{key}.json'
+
+    def get(self, key, output_path):
+        """Copy the entry of `key` to `output_path` and return whether there was one."""
+        try:
+            shutil.copyfile(self.path(key), output_path)
+            # the modification time orders the entries for the eviction
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, output_path):
+        tmp_path = self.directory / f'.{key}.{os.getpid()}.tmp'
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+# decoding args that can change the predictions
+CACHE_KEY_ARGS = ['beam', 'nbest', 'max_len_a', 'max_len_b', 'min_len', 'unkpen', 'lenpen', 'temperature',
+                  'sampling', 'sampling_topk', 'sampling_topp', 'no_repeat_ngram_size', 'prefix_size',
+                  'match_source_len', 'remove_bpe', 'model_overrides', 'autocast', 'fast_greedy', 'left_pad_source',
+                  'left_pad_target', 'max_source_positions', 'max_target_positions', 'skip_invalid_size_inputs_valid_test']
+
+def hash_files(paths):
+    h = hashlib.sha1()
+    for path in sorted(str(path) for path in paths):
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def generation_cache_key(args, checkpoints_hash, subset, raw_file=None):
+    """Key of the predictions for `subset` (or the raw source file `raw_file`): a hash of the checkpoint files, the
+    binarized data of the subset and the dictionaries, and the decoding args."""
+    data_path = pathlib.Path(args.data.split(':')[0])
+    data_files = list(data_path.glob('dict.*.txt'))
+    data_files += [raw_file] if raw_file is not None else list(data_path.glob(f'{subset}.*'))
+    decoding_args = {name: getattr(args, name, None) for name in CACHE_KEY_ARGS}
+    h = hashlib.sha1()
+    h.update(checkpoints_hash.encode())
+    h.update(hash_files(data_files).encode())
+    h.update(json.dumps(decoding_args, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def parse_raw_files(gen_raw_files):
+    """Parse --gen-raw-files into an ordered {subset name: path} dict."""
+    raw_files = collections.OrderedDict()
+    for item in gen_raw_files.split(',') if gen_raw_files else []:
+        name, path = item.split('=', 1) if '=' in item else (pathlib.Path(item).stem, item)
+        assert name not in raw_files, f'{name!r} is given twice in --gen-raw-files, use name=path to tell them apart'
+        raw_files[name] = path
+    return raw_files
+
+def load_raw_dataset(args, task, path):
+    """Build a source-only dataset from a raw source file (one tokenized example per line, e.g. the
+    data/test.src of another depth or span of the task), with the dictionaries of the task."""
+    src_dict = task.source_dictionary
+    with open(path, encoding='utf8') as f:
+        src_tokens = [src_dict.encode_line(line, add_if_not_exist=False).long() for line in f]
+    src_sizes = np.array([len(tokens) for tokens in src_tokens])
+    return LanguagePairDataset(
+        src_tokens, src_sizes, src_dict, tgt_dict=task.target_dictionary,
+        left_pad_source=args.left_pad_source, left_pad_target=args.left_pad_target,
+        max_source_positions=args.max_source_positions, max_target_positions=args.max_target_positions,
+    )
 
 def main(args):
     assert args.path is not None, '--path required for generation!'
@@ -26,37 +288,54 @@ def main(args):
 
     utils.import_user_module(args)
 
-    # Load dataset splits
-    task = tasks.setup_task(args)
-    task.load_dataset(args.gen_subset)
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    # the task and the model are set up once, for all subsets
+    timer = PhaseTimer()
+
+    with timer('setup_task'):
+        task = tasks.setup_task(args)
+
+    subsets = args.gen_subset.split(',')
+    raw_files = parse_raw_files(args.gen_raw_files)
+    assert not set(subsets) & set(raw_files), '--gen-raw-files names must differ from the --gen-subset ones'
 
-    src_dict = getattr(task, 'source_dictionary', None)
     tgt_dict = task.target_dictionary
     
-    n_tries = 0
-    while n_tries < MAX_RELOAD_TRIES:
-        try:
-            models, _model_args = checkpoint_utils.load_model_ensemble(
-                args.path.split(':'),
-                arg_overrides=eval(args.model_overrides),
-                task=task,
-            )
-            break
-        except Exception as e:
-            # many kinds of exceptions can happen, EOFError, FileNotFoundError, OSError, RuntimeError, etc.
-            # so we're trying to be general here
-            if n_tries == MAX_RELOAD_TRIES - 1:
-                raise e
-            
-            print(f'Unable to load {str(args.path.split(":"))!r} on {n_tries} try. Retrying...')
-            sleep(WAIT_BETWEEN_RELOAD_TRIES)
-            n_tries += 1
+    paths = args.path.split(':')
+    output_dir = os.path.dirname(args.path)
+    with timer('wait_checkpoint'):
+        # the checkpoints may still be being written (e.g. by a concurrent mdl.py),
+        # wait until they are complete and verified
+        for path in paths:
+            wait_for_checkpoint(path)
 
-    # models, _model_args = checkpoint_utils.load_model_ensemble(
-    #     args.path.split(':'),
-    #     arg_overrides=eval(args.model_overrides),
-    #     task=task,
-    # )
+    # the cache is keyed by the checksums of the checkpoint files (from their completion markers),
+    # so it is looked up before loading the models, which are not loaded at all if every subset is cached
+    cache, keys, pending = None, {}, []
+    if args.gen_cache_dir:
+        cache = GenerationCache(args.gen_cache_dir, args.gen_cache_size * 2 ** 20)
+        checkpoints_hash = ':'.join(checkpoint_sha1(path) for path in paths)
+    for subset in subsets + list(raw_files):
+        subset_timer = PhaseTimer()
+        if cache is not None:
+            with subset_timer('cache_lookup'):
+                keys[subset] = generation_cache_key(args, checkpoints_hash, subset, raw_files.get(subset))
+                cache_hit = cache.get(keys[subset], f'{output_dir}/generated-{subset}.json')
+            if cache_hit:
+                print(f'| {subset}: reusing the cached predictions {cache.path(keys[subset])}')
+                with open(f'{output_dir}/timings-{subset}.json', 'w') as f:
+                    json.dump(dict(setup_seconds=timer.seconds, phase_seconds=subset_timer.seconds, cache_hit=True), f)
+                continue
+        pending.append((subset, subset_timer))
+    if not pending:
+        return
+
+    model_load_start = perf_counter()
+    models, _model_args = checkpoint_utils.load_model_ensemble(
+        paths,
+        arg_overrides=eval(args.model_overrides),
+        task=task,
+    )
 
     # Optimize ensemble for generation
     for model in models:
@@ -64,10 +343,55 @@ def main(args):
             beamable_mm_beam_size=args.beam,
             need_attn=False
         )
-        model.cuda()
+        if use_cuda:
+            model.cuda()
+        if args.compile:
+            # the encoder runs once per batch, the decoder once per generated position;
+            # the lengths vary between batches, so both are compiled for dynamic shapes
+            compile_forward(model.encoder)
+            compile_forward(model.decoder)
+    timer.add('load_model', perf_counter() - model_load_start)
+
+    with timer('build_generator'):
+        if args.fast_greedy:
+            assert len(models) == 1, '--fast-greedy does not support ensembles'
+            assert not (args.sampling or args.prefix_size or args.no_repeat_ngram_size or args.match_source_len), \
+                '--fast-greedy only supports plain greedy decoding'
+            generator = GreedyGenerator(tgt_dict, args)
+        else:
+            generator = task.build_generator(args)
+        # with --greedy-check, every batch is also decoded by fairseq's generator, to compare predictions and speed
+        reference_generator = task.build_generator(args) if args.fast_greedy and args.greedy_check else None
+
+    for subset, subset_timer in pending:
+        with subset_timer('load_dataset'):
+            if subset in raw_files:
+                task.datasets[subset] = load_raw_dataset(args, task, raw_files[subset])
+            else:
+                task.load_dataset(subset)
+        generate_subset(args, task, models, generator, reference_generator, subset, use_cuda, subset_timer, timer)
+        if cache is not None:
+            cache.put(keys[subset], f'{output_dir}/generated-{subset}.json')
+
+    # remove unneeded checkpoints
+    # checkpoints = glob(f'{output_dir}/*.pt')
+    # for file in checkpoints:
+    #    try:
+    #        os.remove(file)
+    #    except Exception:
+    #        pass
+
 
+def generate_subset(args, task, models, generator, reference_generator, subset, use_cuda, timer, setup_timer):
+    """Generate the predictions for the examples of `subset` and write them to generated-<subset>.json,
+    and the timings to timings-<subset>.json, next to the checkpoint."""
+    src_dict = getattr(task, 'source_dictionary', None)
+    tgt_dict = task.target_dictionary
+    n_mismatches = 0
+
+    iterator_start = perf_counter()
     itr = task.get_batch_iterator(
-        dataset=task.dataset(args.gen_subset),
+        dataset=task.dataset(subset),
         max_tokens=args.max_tokens,
         max_sentences=args.max_sentences,
         max_positions=utils.resolve_max_positions(
@@ -80,16 +404,30 @@ def main(args):
         shard_id=args.shard_id,
         num_workers=args.num_workers,
     ).next_epoch_itr(shuffle=False)
-
-    generator = task.build_generator(args)
+    timer.add('build_iterator', perf_counter() - iterator_start)
     
     output_dir = os.path.dirname(args.path)
+    n_batches = n_sentences = 0
+    first_batch_seconds = None
+    profiler = None
+    if args.profile_batches:
+        profiler = WindowProfiler(f'{output_dir}/profile-generate-{subset}', 0, args.profile_batches, use_cuda)
     with progress_bar.build_progress_bar(args, itr) as t, \
-         open(f'{output_dir}/generated-{args.gen_subset}.json', 'wt', encoding='utf8') as out_file:
+         open(f'{output_dir}/generated-{subset}.json', 'wt', encoding='utf8') as out_file:
+        writer = PredictionWriter(out_file, src_dict, tgt_dict, args.remove_bpe,
+                                  echo=args.echo_predictions, background=args.async_output)
+        data_start = perf_counter()
         for sample in t:
-            sample = utils.move_to_cuda(sample)
+            timer.add('data', perf_counter() - data_start)
+            with timer('to_device'):
+                sample = utils.move_to_cuda(sample) if use_cuda else sample
             if 'net_input' not in sample:
+                data_start = perf_counter()
                 continue
+            if profiler is not None:
+                profiler.step(n_batches)
+            n_batches += 1
+            n_sentences += len(sample['id'])
 
             prefix_tokens = None
             
@@ -97,57 +435,98 @@ def main(args):
             # for now, just skip them and it'll be taken into account in the %s. 
             # appears to be due to nans, related to the older version of fairseq this repo uses.
             # see https://github.com/facebookresearch/fairseq/issues/2087
+            error = None
             try:
-                hypos = task.inference_step(generator, models, sample, prefix_tokens)
+                inference_start = perf_counter()
+                with timer('inference'), autocast(args, use_cuda):
+                    hypos = task.inference_step(generator, models, sample, prefix_tokens)
+                if first_batch_seconds is None:
+                    # with --compile, this includes the compilation
+                    first_batch_seconds = perf_counter() - inference_start
             except AssertionError as e:
-                print(e)
+                error = e
+
+            if reference_generator is not None:
+                try:
+                    with timer('reference_inference'), autocast(args, use_cuda):
+                        reference_hypos = task.inference_step(reference_generator, models, sample, prefix_tokens)
+                except AssertionError:
+                    reference_hypos = None
+                if error is None and reference_hypos is not None:
+                    n_mismatches += sum(not torch.equal(hypo[0]['tokens'], reference_hypo[0]['tokens'])
+                                        for hypo, reference_hypo in zip(hypos, reference_hypos))
+                elif (error is None) != (reference_hypos is None):
+                    # skipped by only one of the generators: none of its predictions match
+                    n_mismatches += len(sample['id'])
+
+            if error is not None:
+                print(error)
                 print('AssertionError was raised. Skipping this sample for this seed.')
+                data_start = perf_counter()
                 continue
                 
-            num_generated_tokens = sum(len(h[0]['tokens']) for h in hypos)
-
-            for i, sample_id in enumerate(sample['id'].tolist()):
-                # Remove padding
-                src_tokens = utils.strip_pad(sample['net_input']['src_tokens'][i, :], tgt_dict.pad())
-
-                if src_dict is not None:
-                    src_str = src_dict.string(src_tokens, args.remove_bpe)
-                else:
-                    src_str = ""
-
-                # Process top predictions
-                hypo = hypos[i][0]
-                hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                    hypo_tokens=hypo['tokens'].int().cpu(),
-                    src_str=src_str,
-                    alignment=hypo['alignment'],
-                    align_dict=None,
-                    tgt_dict=tgt_dict,
-                    remove_bpe=args.remove_bpe,
-                )
-
-                result = dict(src=src_str, pred=hypo_str, src_len=len(src_str.split()), pred_len=len(hypo_str.split()))
-                result_line = json.dumps(result)
-                json.dump(result, out_file, ensure_ascii=False)
-                out_file.write('\n')
-                
-                print(result_line)
-    
-    # remove unneeded checkpoints
-    # checkpoints = glob(f'{output_dir}/*.pt')
-    # for file in checkpoints:
-    #    try:
-    #        os.remove(file)
-    #    except Exception:
-    #        pass
+            with timer('output'):
+                # a single device-to-host transfer for the sources and predictions of the batch
+                src_tokens = sample['net_input']['src_tokens']
+                hypo_tokens = torch.nn.utils.rnn.pad_sequence([hypo[0]['tokens'] for hypo in hypos],
+                                                              batch_first=True, padding_value=tgt_dict.pad())
+                tokens = torch.cat([src_tokens, hypo_tokens.to(src_tokens.dtype)], dim=1).cpu()
+                writer.put(tokens[:, :src_tokens.size(1)], tokens[:, src_tokens.size(1):])
+            data_start = perf_counter()
+
+        with timer('output_flush'):
+            writer.close()
+
+    if profiler is not None:
+        profiler.close()
+
+    with open(f'{output_dir}/timings-{subset}.json', 'w') as f:
+        json.dump(dict(setup_seconds=setup_timer.seconds, phase_seconds=timer.seconds,
+                       batches=n_batches, sentences=n_sentences,
+                       first_batch_inference_seconds=first_batch_seconds, compiled=args.compile,
+                       fast_greedy=args.fast_greedy, greedy_mismatches=n_mismatches if reference_generator else None), f)
+    if reference_generator is not None:
+        print(f'| --fast-greedy on {subset}: {n_mismatches} predictions differ from fairseq\'s generator, '
+              f'{timer.seconds.get("reference_inference", 0.) / max(timer.seconds.get("inference", 0.), 1e-9):.2f}x speedup')
 
 
 def cli_main(args):
     parser = options.get_generation_parser()
+    parser.add_argument("--gen-raw-files", type=str, default=None,
+                        help="Comma-separated raw source files (one tokenized example per line) to generate predictions for "
+                        "after the --gen-subset ones (which can also be comma-separated), with the same loaded model; "
+                        "each is written to generated-<name>.json, where <name> is the file name without suffix, "
+                        "or given as name=path.")
+    parser.add_argument("--gen-cache-dir", type=str, default=None,
+                        help="Reuse the predictions of earlier runs with the same model weights, data and decoding args, "
+                        "stored in this directory (can be shared by concurrent jobs).")
+    parser.add_argument("--gen-cache-size", type=int, default=1024,
+                        help="Size limit of --gen-cache-dir in MB; the least recently used predictions are evicted.")
+    parser.add_argument("--echo-predictions", action="store_true",
+                        help="Also print the predictions (json lines, as written to generated-<subset>.json) to stdout.")
+    parser.add_argument("--async-output", action="store_true",
+                        help="Detokenize and write the predictions in a background thread, overlapping with the inference.")
+    parser.add_argument("--num-threads", type=int, default=None,
+                        help="Number of intra-op threads used by torch (e.g. with --cpu).")
+    parser.add_argument("--num-interop-threads", type=int, default=None,
+                        help="Number of inter-op threads used by torch (e.g. with --cpu).")
+    parser.add_argument("--autocast", choices=['bf16', 'fp16'], default=None,
+                        help="Run the generation with mixed precision (torch.autocast) in this dtype.")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the encoder and decoder with torch.compile before generating.")
+    parser.add_argument("--fast-greedy", action="store_true",
+                        help="Decode with a dedicated greedy decoder (incremental state, finished sequences are dropped "
+                        "from the batch) instead of fairseq's beam search with a single beam; the predictions are the same.")
+    parser.add_argument("--greedy-check", action="store_true",
+                        help="With --fast-greedy, also decode every batch with fairseq's generator and report the number "
+                        "of differing predictions and the speedup (in timings-<subset>.json).")
+    parser.add_argument("--profile-batches", type=int, default=0,
+                        help="Record a profiler trace of the first K generation batches, written next to the "
+                        "checkpoint as profile-generate-<subset>.json (Chrome/Perfetto trace) and .txt (operator summary).")
     args = options.parse_args_and_arch(parser, input_args=args)
+    set_thread_counts(args)
     main(args)
 
 
 if __name__ == '__main__':
-    import sys
     cli_main(sys.argv[1:])
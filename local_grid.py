@@ -5,23 +5,31 @@
 # LICENSE file in the root directory of this source tree.
 
 import sys
-from mdl import cli_main as train_main
+from mdl import cli_main as train_main, pin_to_cores
 from generate import cli_main as generate_main
 from concurrent.futures import ProcessPoolExecutor, wait
+import functools
 import itertools
 import json
 import datetime
 import subprocess
 import os
+import multiprocessing
 import torch
 
 
+def init_cpu_worker(worker_ids, n_workers):
+    # each worker process is pinned to its own set of cores for its whole lifetime,
+    # so that concurrently running jobs never share cores
+    pin_to_cores(worker_ids.get(), n_workers)
+
 class ConcurrentWrapper:
-    def __init__(self, runnable, log_dir, job_id):
+    def __init__(self, runnable, log_dir, job_id, cpu=False):
         self.runnable = runnable
         self.args = None
         self.log_dir = log_dir
         self.job_id = job_id
+        self.cpu = cpu
 
     def __call__(self, args):
         stdout_path = pathlib.Path(self.log_dir) / 'stdout'
@@ -33,10 +41,12 @@ class ConcurrentWrapper:
         sys.stdout = self.stdout
         sys.stderr = self.stderr
         cuda_id = -1
-        n_devices = torch.cuda.device_count()
+        n_devices = 0 if self.cpu else torch.cuda.device_count()
         if n_devices > 0:
             cuda_id = self.job_id % n_devices
         print(f'# {json.dumps(args)}', flush=True)
+        if self.cpu:
+            print(f'# cores: {sorted(os.sched_getaffinity(0))}', flush=True)
 
         with torch.cuda.device(cuda_id):
             self.runnable(args)
@@ -68,19 +78,15 @@ def sweep(fname):
         config = json.loads(config_file.read())
     return parse_json_sweep(config)
 
-def combined_run(params):
+def combined_run(params, generate_params=()):
     train_main(params)
 
     checkpoint_path = "--path=" + params[1].split('=')[1] + "/0.pt"
-    # check accuracy on the training set
-    generate_train_params = [params[0].strip(), checkpoint_path, '--beam=1',
-                             '--batch-size=128', '--gen-subset=train']
-    generate_main(generate_train_params)
-    
-    # check accuracy on the test set
-    generate_test_params = [params[0].strip(), checkpoint_path, '--beam=1', 
-                            '--batch-size=128', '--gen-subset=test']
-    generate_main(generate_test_params)
+    device_params = ['--cpu'] if '--cpu' in params else []
+    # check accuracy on the training and test sets, loading the model once
+    generate_params = [params[0].strip(), checkpoint_path, '--beam=1',
+                       '--batch-size=128', '--gen-subset=train,test'] + device_params + list(generate_params)
+    generate_main(generate_params)
 
 if __name__ == '__main__':
     import pathlib
@@ -91,13 +97,24 @@ if __name__ == '__main__':
     parser.add_argument("--name", type=str)
     parser.add_argument("--n_workers", type=int, default=None)
     parser.add_argument("--task", type=str)
+    parser.add_argument("--cpu", action="store_true",
+                        help="Run on CPU, pinning each worker to a disjoint set of cores")
+    parser.add_argument("--gen-cache-dir", type=str, default=None,
+                        help="Cache of generated predictions shared by the runs (see generate.py --gen-cache-dir)")
+    parser.add_argument("--fast-greedy", action="store_true",
+                        help="Generate with the dedicated greedy decoder (see generate.py --fast-greedy)")
+    parser.add_argument("--greedy-check", action="store_true",
+                        help="With --fast-greedy, compare its predictions with fairseq's generator (see generate.py --greedy-check)")
 
     args = parser.parse_args()
 
     if args.name is None: args.name = args.task
     assert args.sweep and args.name
     
-    if not args.n_workers:
+    if not args.n_workers and args.cpu:
+        print('n_workers is not specified, using 1 instead')
+        args.n_workers = 1
+    elif not args.n_workers:
         device_count = torch.cuda.device_count()
         print(f'n_workers is not specified, using cuda.device_count instead ({device_count})')
         args.n_workers = device_count
@@ -119,22 +136,40 @@ if __name__ == '__main__':
 
     hyper_grid = sweep(args.sweep)
 
+    generate_params = []
+    if args.gen_cache_dir:
+        generate_params.append(f'--gen-cache-dir={args.gen_cache_dir}')
+    if args.fast_greedy:
+        generate_params.append('--fast-greedy')
+    if args.greedy_check:
+        generate_params.append('--greedy-check')
+
     jobs_array = []
 
-    with ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+    executor_kwargs = {}
+    if args.cpu:
+        worker_ids = multiprocessing.Queue()
+        for worker_id in range(args.n_workers):
+            worker_ids.put(worker_id)
+        executor_kwargs = dict(initializer=init_cpu_worker, initargs=(worker_ids, args.n_workers))
+
+    with ProcessPoolExecutor(max_workers=args.n_workers, **executor_kwargs) as executor:
         for combo_id, combo in enumerate(hyper_grid):
             path = args.root_dir / str(combo_id)
             path.mkdir()
             
             train_params = [str(data_path), f'--save-dir={str(path)}', 
                             '--disable-validation', '--no-epoch-checkpoints', '--sentence-avg'] + combo
+            if args.cpu:
+                train_params.append('--cpu')
             
             with open(path / 'params', 'w') as f:
                 json.dump(dict(train_params=train_params), f)
 
-            runner = ConcurrentWrapper(runnable=combined_run,
+            runner = ConcurrentWrapper(runnable=functools.partial(combined_run, generate_params=generate_params),
                                        log_dir=path,
-                                       job_id=combo_id)
+                                       job_id=combo_id,
+                                       cpu=args.cpu)
             job = executor.submit(runner, train_params)
             print(' '.join(train_params))
             combined_run(train_params)
@@ -144,7 +179,8 @@ if __name__ == '__main__':
     wait(jobs_array)
     
     # remove unneeded checkpoints to save space
-    checkpoints = sorted(args.root_dir.glob('**/*.pt'))
+    # (their completion markers first, so that a checkpoint is never left with a marker but no file)
+    checkpoints = sorted(args.root_dir.glob('**/*.pt.done')) + sorted(args.root_dir.glob('**/*.pt'))
     for checkpoint in checkpoints:
         try: 
             os.remove(checkpoint)
@@ -11,22 +11,40 @@ import collections
 import random
 import pathlib
 import json
+import copy
+import contextlib
+import hashlib
+import math
+import os
+
+from itertools import chain
 
 import numpy as np
 import torch
 
-from fairseq import checkpoint_utils, options, progress_bar, tasks, utils
+from fairseq import checkpoint_utils, optim, options, progress_bar, tasks, utils
+from fairseq.optim import lr_scheduler
 from fairseq.data import iterators
 from fairseq.trainer import Trainer
 from fairseq.criterions import CRITERION_REGISTRY
-from fairseq.meters import AverageMeter
+from fairseq.meters import AverageMeter, TimeMeter
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from time import sleep
+from time import sleep, perf_counter
 
-# there are some timing issues when loading the initial checkpoint
-# we'll allow up to 10 retries before exiting
-MAX_RELOAD_TRIES = 10
-WAIT_BETWEEN_RELOAD_TRIES = 120/MAX_RELOAD_TRIES # wait up to 2 minutes total
+# checkpoints are written to a temporary file that is renamed once complete, and then a completion
+# marker with their size (and checksum) is written next to them (<checkpoint>.done); loaders wait for the marker
+# instead of retrying on whatever a partially written file raises
+CHECKPOINT_MARKER_SUFFIX = '.done'
+CHECKPOINT_WAIT_SECONDS = 120 # give up on a checkpoint that does not show up within 2 minutes
+UNMARKED_CHECKPOINT_GRACE_SECONDS = 2 # checkpoints written without a marker (by older versions) are loaded after this
+# args that do not change the results of the steps, and may differ when resuming from the progress journal
+JOURNAL_IGNORED_ARGS = {
+    'save_dir', 'mdl_resume', 'mdl_parallel_workers', 'num_workers', 'num_threads', 'num_interop_threads',
+    'mdl_log_every', 'log_interval', 'log_format', 'no_progress_bar', 'tensorboard_logdir',
+    'profile_step', 'profile_updates', 'compile_benchmark_updates',
+}
 
 def get_training_stats(trainer):
     stats = collections.OrderedDict()
@@ -52,6 +70,366 @@ def get_training_stats(trainer):
     stats['train_wall'] = trainer.get_meter('train_wall')
     return stats
 
+class PhaseTimer:
+    """Accumulates the wall-clock time spent in named phases: `with timer('train'): ...`.
+    Meant to wrap whole phases (a step's training, a checkpoint save), not single updates."""
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, perf_counter() - start)
+
+    def add(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.) + seconds
+
+class WindowProfiler:
+    """Records a profiler trace over the items (updates, generation batches) `start` <= i < `stop` 
+    and writes it as a Chrome/Perfetto trace to `<path>.json` and an operator summary to `<path>.txt`.
+    `step(i)` is called before each item, `close()` once all items are done."""
+
+    def __init__(self, path, start, stop, use_cuda):
+        self.path = path
+        self.use_cuda = use_cuda
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if use_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # the item before the window, if any, warms the profiler up
+        warmup = 1 if start > 0 else 0
+        active = stop - start if stop is not None else sys.maxsize
+        self.profile = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=start - warmup, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=self.write)
+        self.last = None
+
+    def step(self, i):
+        if self.profile is None or i == self.last:
+            return
+        if self.last is None:
+            self.profile.start()
+            self.last = 0
+        # the profiler's step count follows the item index
+        for _ in range(i - self.last):
+            self.profile.step()
+        self.last = i
+
+    def close(self):
+        if self.profile is None:
+            return
+        profile, self.profile = self.profile, None
+        if self.last is not None:
+            # writes the trace if the window was still open
+            profile.stop()
+
+    def write(self, profile):
+        profile.export_chrome_trace(f'{self.path}.json')
+        sort_by = 'cuda_time_total' if self.use_cuda else 'cpu_time_total'
+        with open(f'{self.path}.txt', 'w') as f:
+            f.write(profile.key_averages().table(sort_by=sort_by))
+        print(f'| wrote profiler trace to {self.path}.json')
+
+def write_timings(path, setup_seconds, step_seconds):
+    """Write the per-phase timings of a run (setup and one dict per step) as json."""
+    total = collections.OrderedDict(setup_seconds)
+    for seconds in step_seconds:
+        for phase, value in seconds.items():
+            total[phase] = total.get(phase, 0.) + value
+    with open(path, 'w') as f:
+        json.dump(dict(setup=setup_seconds, steps=step_seconds, total=total), f)
+
+def snapshot_trainer_state(trainer):
+    """Copy the model, criterion, optimizer, lr scheduler and meters state into memory."""
+    return dict(
+        model={k: v.detach().clone() for k, v in trainer.get_model().state_dict().items()},
+        criterion={k: v.detach().clone() for k, v in trainer.get_criterion().state_dict().items()},
+        optimizer=copy.deepcopy(trainer.optimizer.state_dict()),
+        lr_scheduler=copy.deepcopy(trainer.lr_scheduler.state_dict()),
+        meters=copy.deepcopy(trainer.meters),
+    )
+
+def restore_trainer_state(trainer, snapshot, reset_optimizer=False):
+    """Restore a state captured by `snapshot_trainer_state` in place, as `load_initial_checkpoint` reloads it
+    from disk: the weights and meters and, only with `reset_optimizer`, the optimizer and lr scheduler state."""
+    trainer.get_model().load_state_dict(snapshot['model'], strict=True, args=trainer.args)
+    if utils.has_parameters(trainer.get_criterion()):
+        trainer.get_criterion().load_state_dict(snapshot['criterion'], strict=True)
+    if reset_optimizer:
+        trainer.optimizer.load_state_dict(copy.deepcopy(snapshot['optimizer']))
+        trainer.lr_scheduler.load_state_dict(snapshot['lr_scheduler'])
+        trainer.set_num_updates(0)
+    # as Trainer.load_checkpoint does with the extra state of initial.pt
+    trainer.meters.update(copy.deepcopy(snapshot['meters']))
+    for meter in trainer.meters.values():
+        if isinstance(meter, TimeMeter):
+            meter.reset()
+    trainer.lr_step(0)
+
+def compile_forward(module, dynamic=True):
+    """Replace the forward pass of `module` with a torch.compile'd one (--compile). The parameters stay the same
+    tensors, so the in-place state resets keep the compiled code valid and the checkpoints are unchanged.
+    The batch and sequence lengths vary from batch to batch, so they are compiled as dynamic dimensions."""
+    module.forward = torch.compile(module.forward, dynamic=dynamic)
+    return module
+
+def compiled_graph_count():
+    """Number of graphs compiled by torch.compile so far in this process (every recompilation adds one), or None
+    if this torch version does not expose the (private) counter."""
+    try:
+        return int(torch._dynamo.utils.counters['stats']['unique_graphs'])
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+def time_forward_backward(trainer, sample, n_updates):
+    """Mean time of a training forward/backward pass on `sample`; the gradients are discarded."""
+    model, criterion = trainer.get_model(), trainer.get_criterion()
+    model.train()
+    criterion.train()
+    start = perf_counter()
+    for _ in range(n_updates):
+        loss, _, _ = criterion(model, sample)
+        loss.backward()
+    if trainer.cuda:
+        torch.cuda.synchronize()
+    seconds = (perf_counter() - start) / max(n_updates, 1)
+    trainer.zero_grad()
+    return seconds
+
+def compile_trainer_model(args, trainer, sample):
+    """Compile the model of `trainer` once for the whole job and return the compile time and, with
+    --compile-benchmark-updates, the eager vs compiled time of a training update on `sample`."""
+    if trainer.cuda:
+        sample = utils.move_to_cuda(sample)
+    n_updates = args.compile_benchmark_updates
+    stats = dict(arch=args.arch)
+    if n_updates > 0:
+        time_forward_backward(trainer, sample, 1) # warm-up
+        stats['eager_seconds_per_update'] = time_forward_backward(trainer, sample, n_updates)
+
+    compile_forward(trainer.get_model())
+    # torch.compile is lazy, the first pass includes the compilation
+    stats['compile_seconds'] = time_forward_backward(trainer, sample, 1)
+    stats['graphs'] = compiled_graph_count()
+
+    if n_updates > 0:
+        stats['compiled_seconds_per_update'] = time_forward_backward(trainer, sample, n_updates)
+        stats['speedup'] = stats['eager_seconds_per_update'] / stats['compiled_seconds_per_update']
+    print(f'| compiled {args.arch}: {json.dumps(stats)}')
+    return stats
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_checkpoint_marker(path):
+    try:
+        with open(str(path) + CHECKPOINT_MARKER_SUFFIX) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def publish_checkpoint(tmp_path, path, checksum=None):
+    """Rename the complete checkpoint `tmp_path` to `path` and write its completion marker, with its size
+    and, if given, its sha1 `checksum`."""
+    marker_path = path + CHECKPOINT_MARKER_SUFFIX
+    # when overwriting, the marker of the previous checkpoint must not be paired with the new one
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+    os.replace(tmp_path, path)
+    marker = dict(size=os.path.getsize(path))
+    if checksum is not None:
+        marker['sha1'] = checksum
+    with open(f'{marker_path}.tmp{os.getpid()}', 'w') as f:
+        json.dump(marker, f)
+    os.replace(f'{marker_path}.tmp{os.getpid()}', marker_path)
+
+@contextlib.contextmanager
+def atomic_checkpoint(path, checksum=False):
+    """Yield a temporary path to write the checkpoint `path` to; once it is written, it is renamed to `path`
+    and its completion marker is written. Hashing costs a full read of the checkpoint, so its sha1 is only
+    added to the marker with `checksum`, for the checkpoints loaded by other processes."""
+    path = str(path)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    try:
+        yield tmp_path
+        publish_checkpoint(tmp_path, path, file_sha1(tmp_path) if checksum else None)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def save_checkpoint(trainer, path, extra_state, checksum=False):
+    with atomic_checkpoint(path, checksum) as tmp_path:
+        trainer.save_checkpoint(tmp_path, extra_state)
+
+def copy_checkpoint(src, dst):
+    """Copy a checkpoint (to last.pt, which other processes load), hashing it while it is copied."""
+    dst = str(dst)
+    tmp_path = f'{dst}.tmp{os.getpid()}'
+    h = hashlib.sha1()
+    try:
+        with open(src, 'rb') as src_file, open(tmp_path, 'wb') as dst_file:
+            for chunk in iter(lambda: src_file.read(1 << 20), b''):
+                h.update(chunk)
+                dst_file.write(chunk)
+        publish_checkpoint(tmp_path, dst, h.hexdigest())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def checkpoint_sha1(path):
+    """sha1 of a complete checkpoint, from its completion marker (or hashed, if it has none)."""
+    marker = read_checkpoint_marker(path)
+    return marker.get('sha1') if marker is not None and marker.get('sha1') else file_sha1(path)
+
+# (path, mtime, size) of the checkpoints whose checksum was verified, so that initial.pt
+# is only hashed once when it is reloaded at every step
+_verified_checkpoints = set()
+
+def wait_for_checkpoint(path, timeout=CHECKPOINT_WAIT_SECONDS):
+    """Wait until the checkpoint `path` is complete, polling for it and its completion marker with an exponential
+    backoff (from 1ms to 1s), and check it against the marker's size and checksum (if it has one). Raises a
+    TimeoutError if it is not written within `timeout` seconds and a RuntimeError if it is corrupt."""
+    path = str(path)
+    start = perf_counter()
+    delay = 0.001
+    unmarked_since = None
+    while True:
+        marker = read_checkpoint_marker(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # e.g. removed after its marker was read, treated like a missing marker
+            stat = None
+
+        if marker is not None and stat is not None:
+            key = (path, stat.st_mtime_ns, stat.st_size)
+            if key in _verified_checkpoints:
+                return
+            if stat.st_size == marker['size'] and ('sha1' not in marker or file_sha1(path) == marker['sha1']):
+                _verified_checkpoints.add(key)
+                return
+            # unless the checkpoint was overwritten in the meantime (which replaces its marker), it is corrupt
+            if read_checkpoint_marker(path) == marker:
+                raise RuntimeError(f'Checkpoint {path!r} is corrupt: it does not match the size or checksum of '
+                                   f'{path + CHECKPOINT_MARKER_SUFFIX!r}')
+            # being overwritten: wait for the new checkpoint with the same backoff and timeout
+
+        elapsed = perf_counter() - start
+        if marker is None and stat is not None:
+            unmarked_since = elapsed if unmarked_since is None else unmarked_since
+            if elapsed - unmarked_since > UNMARKED_CHECKPOINT_GRACE_SECONDS:
+                print(f'| {path} has no completion marker, loading it without verification', file=sys.stderr)
+                return
+        else:
+            unmarked_since = None
+        if elapsed > timeout:
+            raise TimeoutError(f'Checkpoint {path!r} was not written within {timeout} seconds')
+        sleep(delay)
+        delay = min(2 * delay, 1.)
+
+def load_initial_checkpoint(trainer, initial_state_checkpoint, reset_optimizer=False):
+    """Reset the weights to the ones saved in initial.pt. As with `Trainer.load_checkpoint(reset_optimizer=True)`,
+    the optimizer keeps the state of the previous step, unless `reset_optimizer` (--mdl-independent-steps) is set,
+    in which case the optimizer and lr scheduler state of initial.pt are restored as well."""
+    wait_for_checkpoint(initial_state_checkpoint)
+    if reset_optimizer:
+        trainer.load_checkpoint(initial_state_checkpoint)
+    else:
+        trainer.load_checkpoint(initial_state_checkpoint, reset_optimizer=True, reset_lr_scheduler=True)
+
+def block_boundaries(n_examples, args):
+    """End positions of the transmitted blocks among `n_examples` hold-out examples."""
+    assert args.mdl_block_schedule == 'timestamps' or args.mdl_block_size > 0, \
+        f'--mdl-block-size must be positive, got {args.mdl_block_size}'
+    if args.mdl_block_schedule == 'fixed':
+        boundaries = list(range(args.mdl_block_size, n_examples, args.mdl_block_size))
+    elif args.mdl_block_schedule == 'doubling':
+        # blocks of mdl-block-size, mdl-block-size, 2 x mdl-block-size, 4 x mdl-block-size, ...
+        boundaries = []
+        boundary = args.mdl_block_size
+        while boundary < n_examples:
+            boundaries.append(boundary)
+            boundary *= 2
+    elif args.mdl_block_schedule == 'timestamps':
+        assert args.mdl_block_timestamps, '--mdl-block-schedule=timestamps requires --mdl-block-timestamps'
+        boundaries = [int(timestamp) for timestamp in args.mdl_block_timestamps.split(',')]
+        assert all(a < b for a, b in zip(boundaries, boundaries[1:])), \
+            f'--mdl-block-timestamps must be increasing, got {args.mdl_block_timestamps}'
+        boundaries = [boundary for boundary in boundaries if 0 < boundary < n_examples]
+    else:
+        raise ValueError(f'Unknown block schedule {args.mdl_block_schedule!r}')
+
+    return boundaries + [n_examples]
+
+def split_into_blocks(test_examples, args):
+    """Split the (shuffled) hold-out examples into the blocks transmitted at each step."""
+    starts = [0] + block_boundaries(len(test_examples), args)
+    return [test_examples[start:end] for start, end in zip(starts, starts[1:]) if end > start]
+
+def open_journal(args, blocks):
+    """Return the steps already recorded in the progress journal of --save-dir (with --mdl-resume), 
+    starting a new journal if there is none to resume from."""
+    journal_path = pathlib.Path(args.save_dir) / 'mdl-progress.jsonl'
+    fingerprint = hashlib.sha1(json.dumps(blocks).encode()).hexdigest()
+    # round-tripped through json, so that they compare equal to the ones read back
+    result_args = json.loads(json.dumps({k: v for k, v in sorted(vars(args).items()) if k not in JOURNAL_IGNORED_ARGS},
+                                        default=str))
+
+    completed = {}
+    if args.mdl_resume and journal_path.exists():
+        with open(journal_path, 'rb+') as journal:
+            header_line = journal.readline()
+            try:
+                header = json.loads(header_line) if header_line.endswith(b'\n') else None
+            except json.JSONDecodeError:
+                header = None
+            if header is not None:
+                if header.get('blocks') != fingerprint:
+                    raise ValueError(f'{journal_path} was written for different blocks, cannot resume from it')
+                journal_args = header.get('args', {})
+                changed = sorted(k for k in set(journal_args) | set(result_args) if journal_args.get(k) != result_args.get(k))
+                if changed:
+                    raise ValueError(f'{journal_path} was written with different args ({", ".join(changed)}), '
+                                     'cannot resume from it')
+                # offset of the end of the last complete line
+                offset = journal.tell()
+                for line in journal:
+                    try:
+                        # the last line may be truncated if the job was killed while writing it
+                        entry = json.loads(line) if line.endswith(b'\n') else None
+                    except json.JSONDecodeError:
+                        entry = None
+                    if entry is None:
+                        break
+                    completed[entry['step']] = entry
+                    offset += len(line)
+                # drop the truncated line, so that the next entries are appended after a complete one
+                journal.truncate(offset)
+        if header is not None:
+            print(f'| resuming from {journal_path}: {len(completed)} of {len(blocks)} steps are done')
+            return journal_path, completed
+        # killed while writing the header, before any step was done
+        print(f'| {journal_path} has a truncated header, starting a new journal', file=sys.stderr)
+
+    with open(journal_path, 'w') as journal:
+        journal.write(json.dumps(dict(blocks=fingerprint, args=result_args)) + '\n')
+    return journal_path, completed
+
+def append_to_journal(journal_path, entry):
+    """Append a completed step to the progress journal, making sure it reaches the disk."""
+    with open(journal_path, 'a') as journal:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+
 def main(args, init_distributed=False):
     utils.import_user_module(args)
 
@@ -60,26 +438,53 @@ def main(args, init_distributed=False):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    # Setup task, (should be default, translation)
-    task = tasks.setup_task(args)
-    
-    # Build model and criterion
-    model = task.build_model(args)
-    criterion = task.build_criterion(args)
+    setup_timer = PhaseTimer()
+
+    with setup_timer('setup'):
+        # Setup task, (should be default, translation)
+        task = tasks.setup_task(args)
+        
+        # Build model and criterion
+        model = task.build_model(args)
+        criterion = task.build_criterion(args)
+
+        # Build trainer
+        # (with --mdl-parallel-workers, the steps are trained by the workers' trainers,
+        # this process only builds the initial weights and hands them over)
+        parallel = args.mdl_parallel_workers > 1
+        trainer = None if parallel else Trainer(args, task, model, criterion)
 
-    # Build trainer
-    trainer = Trainer(args, task, model, criterion)
     initial_state_checkpoint = str(pathlib.Path(args.save_dir) / 'initial.pt')
-    trainer.save_checkpoint(initial_state_checkpoint, {'epoch': 0})
+    if not parallel and (not args.mdl_reset_from_memory or args.mdl_save_initial):
+        with setup_timer('checkpoint_save'):
+            save_checkpoint(trainer, initial_state_checkpoint, {'epoch': 0}, checksum=True)
+
+    # with --mdl-reset-from-memory, the initial state is restored in place at every step
+    # instead of being deserialized from initial.pt
+    initial_state = None
+    if args.mdl_reset_from_memory and not parallel:
+        initial_state = snapshot_trainer_state(trainer)
+
+    # if initial.pt was written anyway, time a single reset from disk so that the saving per step
+    # can be reported (without it, a reset from disk is not worth a disk round trip)
+    disk_reset_time = None
+    if initial_state is not None and args.mdl_save_initial:
+        reset_start = perf_counter()
+        load_initial_checkpoint(trainer, initial_state_checkpoint, args.mdl_independent_steps)
+        disk_reset_time = perf_counter() - reset_start
 
     epochs = args.mdl_epochs
-    batch_size = args.mdl_batch_size
-    block_size = args.mdl_block_size
-    batches_per_epoch = args.mdl_batches_per_epoch
 
-    epoch_itr = trainer.get_train_iterator(epoch=0, load_dataset=True)
+    with setup_timer('load_dataset'):
+        if parallel:
+            task.load_dataset(args.train_subset, epoch=0, combine=True)
+            epoch_itr, dataset = None, task.dataset(args.train_subset)
+        else:
+            epoch_itr = trainer.get_train_iterator(epoch=0, load_dataset=True)
+            dataset = epoch_itr.dataset
+    batch_cache = FrozenBatchCache(dataset, trainer.cuda) if args.mdl_cache_batches and not parallel else None
 
-    examples = list(range(len(epoch_itr.dataset)))
+    examples = list(range(len(dataset)))
     if args.mdl_train_examples == 0:
         args.mdl_train_examples = len(examples)
     
@@ -88,109 +493,785 @@ def main(args, init_distributed=False):
     
     random.shuffle(test_examples)
     blocks =  [train_examples]
-    blocks += [test_examples[i:i + block_size] for i in range(0, len(test_examples), block_size)]
+    blocks += split_into_blocks(test_examples, args)
+
+    # compiled once; the per-step state resets load the weights in place, so the compiled code is reused by every step
+    compile_stats = None
+    if args.compile and not parallel:
+        with setup_timer('compile'):
+            first_batch = train_examples[:args.mdl_batch_size] if args.mdl_batch_size else train_examples
+            compile_stats = compile_trainer_model(args, trainer, dataset.collater([dataset[i] for i in first_batch]))
 
     allowed_examples = []
     steps = len(blocks)
-    block_cross_entropys = []
+
+    journal_path, entries = open_journal(args, blocks)
+    resumed_entry = None
+
+    if parallel:
+        initial_weights = dict(model=model.state_dict(), criterion=criterion.state_dict())
+        entries = run_steps_in_parallel(args, initial_weights, blocks, journal_path, entries)
+        step = steps - 1
+        copy_checkpoint(pathlib.Path(args.save_dir) / f'{step}.pt', pathlib.Path(args.save_dir) / 'last.pt')
+        steps = 0 # nothing is left to run in this process
 
     for step in range(steps):
-        n_tries = 0
-        while n_tries < MAX_RELOAD_TRIES:
-            try:
-                trainer.load_checkpoint(initial_state_checkpoint, reset_optimizer=True, reset_lr_scheduler=True)
-                break
-            except Exception as e:
-                # many kinds of exceptions can happen, EOFError, FileNotFoundError, OSError, etc.
-                # so we're trying to be general here
-                if n_tries == MAX_RELOAD_TRIES - 1:
-                    raise e
-                
-                print(f'Unable to load {initial_state_checkpoint!r} on {n_tries} try. Retrying...')
-                sleep(WAIT_BETWEEN_RELOAD_TRIES)
-                n_tries += 1        
-        
-        #trainer.load_checkpoint(initial_state_checkpoint, reset_optimizer=True, reset_lr_scheduler=True)
+        # with --mdl-warm-start, only the first step starts from the initial state,
+        # later steps continue training the previous step's model and optimizer
+        warm_start = args.mdl_warm_start and step > 0
+        step_epochs = args.mdl_warm_start_epochs if warm_start else epochs
+
+        if step in entries:
+            # done before the run was interrupted
+            resumed_entry = entries[step]
+            allowed_examples += blocks[step]
+            continue
 
-        epoch_itr = trainer.get_train_iterator(epoch=step, load_dataset=False)
+        if resumed_entry is not None:
+            # with --mdl-warm-start, continue from the model of the last completed step; otherwise, unless
+            # --mdl-independent-steps is set, the optimizer state carries over from the last completed step
+            # (the weights are reset right after)
+            if warm_start or not args.mdl_independent_steps:
+                previous_checkpoint = str(pathlib.Path(args.save_dir) / resumed_entry['checkpoint'])
+                wait_for_checkpoint(previous_checkpoint)
+                trainer.load_checkpoint(previous_checkpoint)
+            # and the batch sampling continues where the interrupted run was
+            if resumed_entry.get('rng_state') is not None:
+                version, internal_state, gauss_next = resumed_entry['rng_state']
+                random.setstate((version, tuple(internal_state), gauss_next))
+            resumed_entry = None
+
+        step_start = perf_counter()
+        timer = PhaseTimer()
+        if not warm_start:
+            with timer('state_reset'):
+                if initial_state is not None:
+                    restore_trainer_state(trainer, initial_state, args.mdl_independent_steps)
+                else:
+                    load_initial_checkpoint(trainer, initial_state_checkpoint, args.mdl_independent_steps)
 
         allowed_examples += blocks[step]
 
-        if batch_size:
-        #     batches = tuple([random.choices(allowed_examples, k=batch_size) for _ in range(epochs)])
-            batches = []
-            for _ in range(epochs):
-                batches.extend([allowed_examples[i:i + batch_size] for i in range(0, len(allowed_examples), batch_size)])
-            
-            # if mdl-batches-per-epoch is set, we sample batches with replacement,
-            # otherwise, each batch contains all allowed_examples
-            if batches_per_epoch is not None:
-                modified_batches = []
-                for _ in range(epochs):
-                    modified_batches.extend(random.choices(batches, k=batches_per_epoch))
-                batches = modified_batches
-        else:
-            batches = tuple([allowed_examples for _ in range(epochs)])
-        
-        epoch_itr.frozen_batches = batches
+        # with --mdl-independent-steps, batches are sampled from a per-step generator, as in the
+        # step-parallel workers, so that a step does not depend on the ones before it
+        rng = random.Random(args.seed + step) if args.mdl_independent_steps else random
+        next_block_cross_entropy, n_updates, step_stats = run_step(args, trainer, task, epoch_itr, blocks, step,
+                                                                    allowed_examples, step_epochs, rng=rng,
+                                                                    batch_cache=batch_cache, timer=timer)
 
-        train(args, trainer, task, epoch_itr)
+        with timer('checkpoint_save'):
+            if not args.mdl_warm_start:
+                trainer.set_num_updates(0) #reset the num_update as not systematically updated in load_checkpoint
+            state_checkpoint = str(pathlib.Path(args.save_dir) / f'{step}.pt')
+            # 0.pt is the one generate.py loads after local_grid.py runs
+            save_checkpoint(trainer, state_checkpoint, {'epoch': step}, checksum=step == 0)
 
-        stashed_criterion = trainer.criterion
-        train.criterion = CRITERION_REGISTRY['cross_entropy'](args, task)
-        
-        if step < steps - 1:
-            stashed_criterion = trainer.criterion
-            train.criterion = CRITERION_REGISTRY['cross_entropy'](args, task)
-            next_block = (blocks[step + 1], )
-            next_block_cross_entropy = validate(args, trainer, task, epoch_itr, subsets=['train'], \
-                allowed_batches=next_block)
-            train.criterion = stashed_criterion
-            block_cross_entropys.append(next_block_cross_entropy)
-
-        trainer.set_num_updates(0) #reset the num_update as not systematically updated in load_checkpoint
-        state_checkpoint = str(pathlib.Path(args.save_dir) / f'{step}.pt')
-        trainer.save_checkpoint(state_checkpoint, {'epoch': step})
+        entries[step] = dict(step=step, next_block_cross_entropy=next_block_cross_entropy,
+                             n_updates=n_updates, seconds=perf_counter() - step_start,
+                             phase_seconds=timer.seconds, checkpoint=f'{step}.pt',
+                             rng_state=None if args.mdl_independent_steps else random.getstate(), **step_stats)
+        append_to_journal(journal_path, entries[step])
 
+    entries = [entries[step] for step in range(len(blocks))]
+    block_cross_entropys = [entry['next_block_cross_entropy'] for entry in entries if entry['next_block_cross_entropy'] is not None]
+    updates_per_step = [entry['n_updates'] for entry in entries]
+    reset_times = [entry['phase_seconds']['state_reset'] for entry in entries if 'state_reset' in entry.get('phase_seconds', {})]
+    train_seconds = sum(entry.get('phase_seconds', {}).get('train', 0.) for entry in entries)
 
     examples_seen = [len(b) for b in blocks]
     cross_entropy_sum = sum(n_examples * mean_cross_entropy for n_examples, mean_cross_entropy in zip(examples_seen[1:], block_cross_entropys))
     stats = dict(online_cross_entropy=block_cross_entropys,
                 description_length=cross_entropy_sum,
-                examples_seen=examples_seen)
+                examples_seen=examples_seen,
+                updates_per_step=updates_per_step)
+    if train_seconds > 0:
+        stats['updates_per_second'] = sum(updates_per_step) / train_seconds
+    if reset_times:
+        stats['state_reset_seconds'] = sum(reset_times) / len(reset_times)
+    if disk_reset_time is not None and reset_times:
+        stats['state_reset_disk_seconds'] = disk_reset_time
+        stats['state_reset_saved_seconds'] = disk_reset_time - stats['state_reset_seconds']
+    if any('padding_ratio' in entry for entry in entries):
+        stats['padding_ratio'] = [entry.get('padding_ratio') for entry in entries]
+        stats['tokens_per_second'] = [entry.get('tokens_per_second') for entry in entries]
+    if batch_cache is not None:
+        stats['batch_cache'] = batch_cache.stats()
+    if compile_stats is not None:
+        # graphs compiled after the first pass, e.g. for the validation (eval mode) or for a new batch shape
+        graphs = compiled_graph_count()
+        compile_stats['recompilations'] = (graphs - compile_stats['graphs']
+                                           if graphs is not None and compile_stats['graphs'] is not None else None)
+        stats['compile'] = compile_stats
+
+    example_cross_entropy_path = pathlib.Path(args.save_dir) / 'example-cross-entropies.npy'
+    write_example_cross_entropies(example_cross_entropy_path, [entry.get('example_cross_entropies') for entry in entries])
+    stats['example_cross_entropies'] = example_cross_entropy_path.name
     print(json.dumps(stats))
+
+    write_timings(pathlib.Path(args.save_dir) / 'timings.json', setup_timer.seconds, 
+                  [entry.get('phase_seconds', {}) for entry in entries])
+    
+    if resumed_entry is not None:
+        # every step was already done before the run was interrupted
+        copy_checkpoint(pathlib.Path(args.save_dir) / resumed_entry['checkpoint'], pathlib.Path(args.save_dir) / 'last.pt')
+    elif not parallel:
+        state_checkpoint = str(pathlib.Path(args.save_dir) / 'last.pt')
+        save_checkpoint(trainer, state_checkpoint, {'epoch': step}, checksum=True)
+
+
+def pin_to_cores(worker_id, n_workers):
+    """Pin the current process to the `worker_id`-th of `n_workers` disjoint sets of the available cores."""
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_worker = max(1, len(cores) // n_workers)
+    first = (worker_id % n_workers) * cores_per_worker % len(cores)
+    core_set = cores[first:first + cores_per_worker]
+    os.sched_setaffinity(0, core_set)
+    torch.set_num_threads(len(core_set))
+    return core_set
+
+def set_thread_counts(args):
+    """Apply --num-threads / --num-interop-threads, if given."""
+    if args.num_interop_threads and args.num_interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(args.num_interop_threads)
+        except RuntimeError as e:
+            # can only be set once per process, before any inter-op parallel work
+            print(f'Unable to set the number of inter-op threads: {e}', file=sys.stderr)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+
+# state of a step-parallel worker process, set up once by `init_step_worker`
+_step_worker = None
+
+def init_step_worker(args, initial_weights, blocks, worker_ids):
+    """Build the task and trainer of a step-parallel worker, pick its device and take the snapshot of the
+    initial state (the initial weights with a fresh optimizer and lr scheduler) that every step starts from."""
+    global _step_worker
+    worker_id = worker_ids.get()
+    n_devices = 0 if args.cpu else torch.cuda.device_count()
+    if n_devices > 0:
+        torch.cuda.set_device(worker_id % n_devices)
+    else:
+        pin_to_cores(worker_id, args.mdl_parallel_workers)
+
+    utils.import_user_module(args)
+    task = tasks.setup_task(args)
+    model = task.build_model(args)
+    criterion = task.build_criterion(args)
+    trainer = Trainer(args, task, model, criterion)
+    trainer.get_model().load_state_dict(initial_weights['model'], strict=True, args=args)
+    if utils.has_parameters(trainer.get_criterion()):
+        trainer.get_criterion().load_state_dict(initial_weights['criterion'], strict=True)
+    initial_state = snapshot_trainer_state(trainer)
+    if worker_id == 0 and args.mdl_save_initial:
+        save_checkpoint(trainer, pathlib.Path(args.save_dir) / 'initial.pt', {'epoch': 0}, checksum=True)
+    if args.compile:
+        compile_forward(trainer.get_model())
+    # the binarized datasets are memory-mapped, so the workers share the OS page cache
+    epoch_itr = trainer.get_train_iterator(epoch=0, load_dataset=True)
+    batch_cache = FrozenBatchCache(epoch_itr.dataset, trainer.cuda) if args.mdl_cache_batches else None
+
+    _step_worker = (args, task, trainer, epoch_itr, initial_state, blocks, batch_cache)
+
+def run_step_worker(step):
+    """Run a single MDL step from the initial state in a step-parallel worker and return its journal entry."""
+    args, task, trainer, epoch_itr, initial_state, blocks, batch_cache = _step_worker
+
+    step_start = perf_counter()
+    timer = PhaseTimer()
+    with timer('state_reset'):
+        # steps run in parallel are independent (--mdl-independent-steps is implied)
+        restore_trainer_state(trainer, initial_state, reset_optimizer=True)
+
+    allowed_examples = [example for block in blocks[:step + 1] for example in block]
+    # batches are sampled from a per-step generator, as in a sequential run with --mdl-independent-steps,
+    # so that results do not depend on which worker runs the step or in which order the steps finish
+    rng = random.Random(args.seed + step)
+    next_block_cross_entropy, n_updates, step_stats = run_step(args, trainer, task, epoch_itr, blocks, step,
+                                                                allowed_examples, args.mdl_epochs,
+                                                                rng=rng, batch_cache=batch_cache, timer=timer)
+
+    with timer('checkpoint_save'):
+        trainer.set_num_updates(0)
+        state_checkpoint = str(pathlib.Path(args.save_dir) / f'{step}.pt')
+        save_checkpoint(trainer, state_checkpoint, {'epoch': step}, checksum=step == 0)
+
+    return dict(step=step, next_block_cross_entropy=next_block_cross_entropy, n_updates=n_updates, 
+                seconds=perf_counter() - step_start, phase_seconds=timer.seconds, checkpoint=f'{step}.pt',
+                **step_stats)
+
+def run_steps_in_parallel(args, initial_weights, blocks, journal_path, completed):
+    """Fan the (independent) MDL steps out over a process pool, one worker per GPU or per group of CPU cores,
+    all starting from the (CPU) `initial_weights` of the model and criterion.
+    Steps found in `completed` are not run again, the others are recorded in the journal as they finish.
+    Returns the journal entries of all steps."""
+    assert not args.mdl_warm_start, '--mdl-warm-start steps depend on each other and cannot run in parallel'
+    
+    ctx = torch.multiprocessing.get_context('spawn')
+    worker_ids = ctx.Queue()
+    for worker_id in range(args.mdl_parallel_workers):
+        worker_ids.put(worker_id)
+    
+    entries = dict(completed)
+    remaining_steps = [step for step in range(len(blocks)) if step not in completed]
+
+    with ProcessPoolExecutor(max_workers=args.mdl_parallel_workers, mp_context=ctx,
+                             initializer=init_step_worker,
+                             initargs=(args, initial_weights, blocks, worker_ids)) as executor:
+        futures = [executor.submit(run_step_worker, step) for step in remaining_steps]
+        for future in as_completed(futures):
+            entry = future.result()
+            entries[entry['step']] = entry
+            append_to_journal(journal_path, entry)
+
+    return entries
+
+
+def main_multi_seed(args):
+    """Train one replica per seed in --mdl-seeds on the same frozen batches in a single process."""
+    utils.import_user_module(args)
+
+    seeds = [int(seed) for seed in args.mdl_seeds.split(',')]
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+
+    # data order (blocks and batches) comes from --seed and is shared by all replicas,
+    # only the initialization and dropout of the replicas depend on their seed
+    # (so only the replica whose seed is --seed matches a single-seed run, with --mdl-independent-steps)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    task = tasks.setup_task(args)
+    task.load_dataset(args.train_subset)
+    dataset = task.dataset(args.train_subset)
+
+    replicas = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        model = task.build_model(args).to(device)
+        criterion = task.build_criterion(args).to(device)
+        initial_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        if args.compile:
+            compile_forward(model)
+        replica_args = copy.copy(args)
+        replica_args.seed = seed
+        save_dir = pathlib.Path(args.save_dir) / f'seed{seed}'
+        save_dir.mkdir(parents=True, exist_ok=True)
+        replicas.append(dict(seed=seed, args=replica_args, model=model, criterion=criterion,
+                             initial_state=initial_state, save_dir=save_dir, block_cross_entropys=[],
+                             example_cross_entropies=[]))
+
+    examples = list(range(len(dataset)))
+    if args.mdl_train_examples == 0:
+        args.mdl_train_examples = len(examples)
+
+    train_examples = examples[:args.mdl_train_examples]
+    test_examples = examples[args.mdl_train_examples:]
+
+    random.shuffle(test_examples)
+    blocks =  [train_examples]
+    blocks += split_into_blocks(test_examples, args)
+
+    def collate(indices):
+        return utils.apply_to_sample(lambda t: t.to(device), dataset.collater([dataset[i] for i in indices]))
+
+    allowed_examples = []
+    steps = len(blocks)
+    for step in range(steps):
+        for replica in replicas:
+            replica['model'].load_state_dict(replica['initial_state'], strict=True, args=replica['args'])
+            params = [p for p in chain(replica['model'].parameters(), replica['criterion'].parameters()) if p.requires_grad]
+            replica['optimizer'] = optim.build_optimizer(args, params)
+            replica['lr_scheduler'] = lr_scheduler.build_lr_scheduler(args, replica['optimizer'])
+            replica['lr_scheduler'].step_update(0)
+
+        allowed_examples += blocks[step]
+        batches = make_batches(allowed_examples, args.mdl_epochs, args.mdl_batch_size, args.mdl_batches_per_epoch,
+                               rng=random.Random(args.seed + step), lazy=args.mdl_lazy_batches,
+                               size=dataset.size if args.mdl_length_buckets else None)
+
+        # every distinct batch is collated and moved to the device once per step
+        collated = {}
+        for num_updates, batch in enumerate(batches):
+            key = tuple(batch)
+            if key not in collated:
+                collated[key] = collate(batch)
+            sample = collated[key]
+
+            # a single backward pass over the summed losses of all replicas;
+            # their parameters are disjoint, so the gradients do not interact
+            total_loss = 0
+            for replica in replicas:
+                torch.manual_seed(replica['seed'] + num_updates)
+                replica['model'].train()
+                replica['optimizer'].zero_grad()
+                loss, sample_size, _ = replica['criterion'](replica['model'], sample)
+                total_loss = total_loss + loss / sample_size
+            total_loss.backward()
+
+            for replica in replicas:
+                replica['optimizer'].clip_grad_norm(args.clip_norm)
+                replica['optimizer'].step()
+                replica['lr_scheduler'].step_update(num_updates + 1)
+
+        if step < steps - 1:
+            sample = collate(blocks[step + 1])
+            with torch.no_grad():
+                for replica in replicas:
+                    loss, sample_size, example_losses = score_sample(replica['model'], replica['criterion'], sample,
+                                                                     task.target_dictionary.pad(), args.sentence_avg)
+                    # same units (bits) as `validate`
+                    replica['block_cross_entropys'].append(loss / sample_size / math.log(2))
+                    replica['example_cross_entropies'].append(example_losses)
+
+        for replica in replicas:
+            with atomic_checkpoint(replica['save_dir'] / f'{step}.pt', checksum=step == 0) as tmp_path:
+                checkpoint_utils.save_state(tmp_path, replica['args'],
+                                            replica['model'].state_dict(), replica['criterion'],
+                                            replica['optimizer'], replica['lr_scheduler'], 0,
+                                            extra_state={'epoch': step})
+
+    examples_seen = [len(b) for b in blocks]
+    for replica in replicas:
+        block_cross_entropys = replica['block_cross_entropys']
+        cross_entropy_sum = sum(n_examples * mean_cross_entropy for n_examples, mean_cross_entropy in zip(examples_seen[1:], block_cross_entropys))
+        stats = dict(seed=replica['seed'],
+                    online_cross_entropy=block_cross_entropys,
+                    description_length=cross_entropy_sum,
+                    examples_seen=examples_seen)
+        write_example_cross_entropies(replica['save_dir'] / 'example-cross-entropies.npy', replica['example_cross_entropies'])
+        stats['example_cross_entropies'] = str(pathlib.Path(replica['save_dir'].name) / 'example-cross-entropies.npy')
+        print(json.dumps(stats))
+
+        copy_checkpoint(replica['save_dir'] / f'{steps - 1}.pt', replica['save_dir'] / 'last.pt')
+
+
+class FrozenBatchCache:
+    """Collates every distinct batch of example indices once and keeps it on the training device,
+    so that the frozen batches (typically the same batch repeated for every update) are replayed
+    without re-indexing, re-collating and re-transferring them."""
+
+    def __init__(self, dataset, use_cuda):
+        self.dataset = dataset
+        self.use_cuda = use_cuda
+        self.samples = {}
+        self.collated_batches = 0
+        self.replayed_batches = 0
+        self.collate_seconds = 0.
+        self.train_seconds = 0.
+
+    def get(self, indices):
+        key = tuple(indices)
+        sample = self.samples.get(key)
+        if sample is None:
+            start = perf_counter()
+            sample = self.dataset.collater([self.dataset[i] for i in indices])
+            if self.use_cuda:
+                sample = utils.move_to_cuda(sample)
+            self.samples[key] = sample
+            self.collated_batches += 1
+            self.collate_seconds += perf_counter() - start
+        else:
+            self.replayed_batches += 1
+        return sample
+
+    def iterate(self, batches):
+        return CachedBatches(self, batches)
+
+    def clear(self):
+        self.samples = {}
+
+    def stats(self):
+        collate_seconds_per_batch = self.collate_seconds / max(self.collated_batches, 1)
+        return dict(collated_batches=self.collated_batches,
+                    replayed_batches=self.replayed_batches,
+                    collate_seconds=self.collate_seconds,
+                    compute_seconds=self.train_seconds - self.collate_seconds,
+                    saved_seconds=self.replayed_batches * collate_seconds_per_batch)
+
+
+class CachedBatches:
+    """Iterable over the cached samples of `batches`."""
+
+    def __init__(self, cache, batches):
+        self.cache = cache
+        self.batches = batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield self.cache.get(batch)
+
+
+class LazyBatchSampler:
+    """Streams the frozen batches of one step without materializing them: `epochs` passes over
+    `chunks` of allowed examples or, with `batches_per_epoch`, that many chunks per epoch sampled
+    with replacement from a generator seeded with `seed`. Memory does not depend on the number of epochs."""
+
+    def __init__(self, chunks, epochs, batches_per_epoch, seed):
+        self.chunks = chunks
+        self.epochs = epochs
+        self.batches_per_epoch = batches_per_epoch
+        self.seed = seed
+
+    def __len__(self):
+        if self.batches_per_epoch is None:
+            return self.epochs * len(self.chunks)
+        return self.epochs * self.batches_per_epoch
+
+    def __iter__(self):
+        if self.batches_per_epoch is None:
+            for _ in range(self.epochs):
+                yield from self.chunks
+        else:
+            # a fresh generator on every pass, so that iterating twice gives the same batches
+            rng = random.Random(self.seed)
+            n_chunks = len(self.chunks)
+            for _ in range(len(self)):
+                yield self.chunks[rng.randrange(n_chunks)]
+
+
+def chunk_examples(allowed_examples, batch_size, size=None):
+    """Split the allowed examples into consecutive chunks of `batch_size`. With `size` (--mdl-length-buckets),
+    the examples are sorted by their (source, target) length first, so that each chunk holds examples of similar
+    length; every example is still in exactly one chunk."""
+    batch_size = batch_size or len(allowed_examples)
+    if size is not None:
+        # stable, so ties keep their (shuffled) order
+        allowed_examples = sorted(allowed_examples, key=size)
+    return [allowed_examples[i:i + batch_size] for i in range(0, len(allowed_examples), batch_size)]
+
+
+def padding_stats(chunks, size):
+    """Return the number of real and of padded (source + target) tokens in one pass over `chunks`."""
+    real_tokens = padded_tokens = 0
+    for chunk in chunks:
+        sizes = [size(i) for i in chunk]
+        src_sizes = [src for src, _ in sizes]
+        tgt_sizes = [tgt for _, tgt in sizes]
+        real_tokens += sum(src_sizes) + sum(tgt_sizes)
+        # the collater pads the sources and targets to the longest ones of the batch
+        padded_tokens += len(chunk) * (max(src_sizes) + max(tgt_sizes))
+    return real_tokens, padded_tokens
+
+
+def split_by_tokens(indices, size, max_tokens):
+    """Split a batch into micro-batches of at most `max_tokens` padded (source + target) tokens
+    (--mdl-max-tokens), grouping examples of similar length. A batch within the budget is returned
+    as is; an example over the budget on its own gets a micro-batch of its own."""
+    sizes = [size(i) for i in indices]
+    n_tokens = len(sizes) * (max(src for src, _ in sizes) + max(tgt for _, tgt in sizes))
+    if n_tokens <= max_tokens:
+        return [indices]
+
+    micro_batches, current = [], []
+    max_src = max_tgt = 0
+    for i, (src, tgt) in sorted(zip(indices, sizes), key=lambda example: example[1]):
+        if current and (len(current) + 1) * (max(max_src, src) + max(max_tgt, tgt)) > max_tokens:
+            micro_batches.append(current)
+            current, max_src, max_tgt = [], 0, 0
+        current.append(i)
+        max_src, max_tgt = max(max_src, src), max(max_tgt, tgt)
+    micro_batches.append(current)
+    return micro_batches
+
+
+class MicroBatchGroups:
+    """Iterable over the frozen `batches` of a step, each yielded as the list of its collated
+    micro-batches (see `split_by_tokens`), so that their gradients are accumulated into a single update."""
+
+    def __init__(self, batches, size, max_tokens, collate):
+        self.batches = batches
+        self.size = size
+        self.max_tokens = max_tokens
+        self.collate = collate
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        # the same batch is typically repeated for every update, so it is only split once
+        splits = {}
+        for batch in self.batches:
+            key = tuple(batch)
+            if key not in splits:
+                splits[key] = split_by_tokens(batch, self.size, self.max_tokens)
+            yield [self.collate(micro_batch) for micro_batch in splits[key]]
+
+
+def make_batches(allowed_examples, epochs, batch_size, batches_per_epoch, rng=random, lazy=False, size=None):
+    """Build the frozen batches used for training at one step. With `size`, the batches group
+    examples of similar length (see `chunk_examples`), in an order shuffled with `rng`."""
+    if batch_size:
+        chunks = chunk_examples(allowed_examples, batch_size, size)
+        if size is not None:
+            # do not present the length buckets from the shortest to the longest
+            rng.shuffle(chunks)
+
+    if lazy:
+        seed = rng.getrandbits(32) if batch_size and batches_per_epoch is not None else None
+        return LazyBatchSampler(chunks if batch_size else [allowed_examples], epochs,
+                                batches_per_epoch if batch_size else None, seed)
+
+    if batch_size:
+    #     batches = tuple([random.choices(allowed_examples, k=batch_size) for _ in range(epochs)])
+        batches = []
+        for _ in range(epochs):
+            batches.extend([list(chunk) for chunk in chunks])
+        
+        # if mdl-batches-per-epoch is set, we sample batches with replacement,
+        # otherwise, each batch contains all allowed_examples
+        if batches_per_epoch is not None:
+            modified_batches = []
+            for _ in range(epochs):
+                modified_batches.extend(rng.choices(batches, k=batches_per_epoch))
+            batches = modified_batches
+    else:
+        batches = tuple([allowed_examples for _ in range(epochs)])
     
-    state_checkpoint = str(pathlib.Path(args.save_dir) / 'last.pt')
-    trainer.save_checkpoint(state_checkpoint, {'epoch': step})
+    return batches
+
+
+def run_step(args, trainer, task, epoch_itr, blocks, step, allowed_examples, epochs, rng=random, batch_cache=None,
+             timer=None):
+    """Train on `allowed_examples` and return the cross-entropy of the next block (None at the last step),
+    the number of updates that were made and a dict with the padding ratio and throughput (in real tokens) of the
+    training batches and the per-example cross-entropies of the next block. The time spent in each phase is added to `timer`."""
+    timer = timer if timer is not None else PhaseTimer()
+
+    dataset = epoch_itr.dataset
+    size = dataset.size if args.mdl_length_buckets else None
+    with timer('batches'):
+        # the train iterator is built once per run, only its frozen batches change from step to step
+        epoch_itr.frozen_batches = make_batches(allowed_examples, epochs, args.mdl_batch_size, 
+                                                args.mdl_batches_per_epoch, rng=rng, lazy=args.mdl_lazy_batches,
+                                                size=size)
+        # over one epoch, which the batches sampled with --mdl-batches-per-epoch match on average
+        chunks = chunk_examples(allowed_examples, args.mdl_batch_size, size)
+        # with --mdl-max-tokens, the padding is that of the micro-batches actually fed to train_step
+        fed_batches = chunks
+        if args.mdl_max_tokens:
+            fed_batches = [micro_batch for chunk in chunks
+                           for micro_batch in split_by_tokens(chunk, dataset.size, args.mdl_max_tokens)]
+        real_tokens, padded_tokens = padding_stats(fed_batches, dataset.size)
+
+    train_start = perf_counter()
+    if batch_cache is not None:
+        # the batches of the previous step are not used anymore
+        batch_cache.clear()
+    profiler = None
+    if args.profile_step is not None and args.profile_step == step:
+        start, stop = 0, None
+        if args.profile_updates:
+            start, stop = [int(update) for update in args.profile_updates.split(':')]
+        profiler = WindowProfiler(str(pathlib.Path(args.save_dir) / f'profile-step{step}'), start, stop, trainer.cuda)
+
+    with timer('train'):
+        n_updates = train(args, trainer, task, epoch_itr, batch_cache=batch_cache, profiler=profiler, timer=timer)
+    if batch_cache is not None:
+        batch_cache.train_seconds += perf_counter() - train_start
+
+    tokens = n_updates * real_tokens / len(chunks)
+    step_stats = dict(padding_ratio=1. - real_tokens / max(padded_tokens, 1),
+                       tokens_per_second=tokens / max(timer.seconds['train'], 1e-9))
+    print(f'| step {step}: padding ratio {step_stats["padding_ratio"]:.3f}, '
+          f'{step_stats["tokens_per_second"]:.0f} tokens/s')
+
+    next_block_cross_entropy = None
+    if step < len(blocks) - 1:
+        stashed_criterion = trainer.criterion
+        train.criterion = CRITERION_REGISTRY['cross_entropy'](args, task)
+        with timer('validate'):
+            next_block_cross_entropy, example_losses = validate(args, trainer, task, subset='train', block=blocks[step + 1])
+        step_stats['example_cross_entropies'] = example_losses
+        train.criterion = stashed_criterion
 
+    return next_block_cross_entropy, n_updates, step_stats
 
-def train(args, trainer, task, epoch_itr):
+
+def autocast(args, use_cuda):
+    """Mixed-precision context for --autocast (bf16 or fp16); does nothing when it is not set.
+    Parameters stay in fp32, so the per-step state resets and checkpoints are unaffected."""
+    if not getattr(args, 'autocast', None):
+        return contextlib.ExitStack() # dummy contextmanager
+    dtype = torch.bfloat16 if args.autocast == 'bf16' else torch.float16
+    return torch.autocast(device_type='cuda' if use_cuda else 'cpu', dtype=dtype)
+
+
+def fast_train_step(trainer, samples, scaler=None):
+    """Single-device equivalent of `trainer.train_step` for --mdl-fast-trainer: forward/backward
+    on the fairseq model and criterion and an optimizer step, without the distributed, OOM-recovery
+    and meter bookkeeping (only the training loss meter is kept). With --autocast=fp16, the losses
+    are scaled by `scaler`; as with fairseq's fp16 optimizer, an update whose gradients overflowed is
+    skipped and returns None, without counting it."""
+    args, task = trainer.args, trainer.task
+    model, criterion, optimizer = trainer.get_model(), trainer.get_criterion(), trainer.optimizer
+
+    # same seeding as the trainer, so that dropout masks match
+    seed = args.seed + trainer.get_num_updates()
+    torch.manual_seed(seed)
+    if trainer.cuda:
+        torch.cuda.manual_seed(seed)
+
+    criterion.train()
+    optimizer.zero_grad()
+
+    logging_outputs, sample_sizes = [], []
+    for sample in samples:
+        if trainer.cuda:
+            sample = utils.move_to_cuda(sample)
+        # as in FairseqTask.train_step, with the forward pass under autocast
+        with autocast(args, trainer.cuda):
+            model.train()
+            loss, sample_size, logging_output = criterion(model, sample)
+        if scaler is not None:
+            loss = scaler.scale(loss)
+        optimizer.backward(loss)
+        logging_outputs.append(logging_output)
+        sample_sizes.append(sample_size)
+
+    logging_output = task.aggregate_logging_outputs(logging_outputs, criterion)
+    sample_size = task.grad_denom(sample_sizes, criterion)
+
+    if scaler is not None:
+        scaler.unscale_(optimizer.optimizer)
+    if sample_size > 0:
+        optimizer.multiply_grads(1. / float(sample_size))
+    optimizer.clip_grad_norm(args.clip_norm)
+    if scaler is not None:
+        # skips the update if the gradients overflowed, which lowers the scale
+        scale = scaler.get_scale()
+        scaler.step(optimizer.optimizer)
+        scaler.update()
+        if scaler.get_scale() < scale:
+            print(f'| WARNING: overflow detected, ignoring gradient (loss scale lowered to {scaler.get_scale()})')
+            optimizer.zero_grad()
+            return None
+    else:
+        optimizer.step()
+    trainer.set_num_updates(trainer.get_num_updates() + 1)
+    task.update_step(trainer.get_num_updates())
+
+    trainer.get_meter('train_loss').update(logging_output.get('loss', 0), sample_size)
+    return logging_output
+
+
+def train(args, trainer, task, epoch_itr, batch_cache=None, profiler=None, timer=None):
     """Train the model for one epoch."""
     # Update parameters every N batches
     update_freq = 1
 
     # Initialize data iterator
-    itr = epoch_itr.next_epoch_itr(
-        fix_batches_to_gpus=args.fix_batches_to_gpus,
-        shuffle=False, # TODO: changed
-    )
+    if args.mdl_max_tokens:
+        # each batch is split into micro-batches that are accumulated into one update, which is
+        # the same as a single update on the whole batch: the gradients of the summed losses are
+        # divided by the total sample size
+        dataset = epoch_itr.dataset
+        if batch_cache is not None:
+            collate = batch_cache.get
+        else:
+            collate = lambda indices: dataset.collater([dataset[i] for i in indices])
+        itr = iterators.CountingIterator(MicroBatchGroups(epoch_itr.frozen_batches, dataset.size,
+                                                          args.mdl_max_tokens, collate))
+    elif batch_cache is not None:
+        itr = iterators.CountingIterator(batch_cache.iterate(epoch_itr.frozen_batches))
+    elif isinstance(epoch_itr.frozen_batches, LazyBatchSampler):
+        # fairseq's epoch iterator would materialize the list of batches,
+        # so the sampler is streamed through a data loader directly
+        itr = iterators.CountingIterator(torch.utils.data.DataLoader(
+            epoch_itr.dataset,
+            collate_fn=epoch_itr.collate_fn,
+            batch_sampler=epoch_itr.frozen_batches,
+            num_workers=args.num_workers,
+        ))
+    else:
+        itr = epoch_itr.next_epoch_itr(
+            fix_batches_to_gpus=args.fix_batches_to_gpus,
+            shuffle=False, # TODO: changed
+        )
 
-    itr = iterators.GroupedIterator(itr, update_freq)
+    if not args.mdl_max_tokens:
+        itr = iterators.GroupedIterator(itr, update_freq)
     progress = progress_bar.build_progress_bar(
         args, itr, no_progress_bar='simple',
     )
 
+    # optional convergence check, every --mdl-stop-check-interval updates on the mean
+    # training loss of the updates since the previous check
+    check_interval = args.mdl_stop_check_interval
+    window_loss, window_updates = 0., 0
+    best_loss, checks_without_improvement = None, 0
+    n_updates = 0
+
+    log_every = args.mdl_log_every
+    log_seconds, n_logged = 0., 0
+
+    if args.mdl_fast_trainer:
+        scaler = torch.cuda.amp.GradScaler() if args.autocast == 'fp16' else None
+        train_step = lambda samples: fast_train_step(trainer, samples, scaler)
+    else:
+        def train_step(samples):
+            with autocast(args, trainer.cuda):
+                return trainer.train_step(samples)
+
     for i, samples in enumerate(progress, start=epoch_itr.iterations_in_epoch):
-        log_output = trainer.train_step(samples)
+        if profiler is not None:
+            profiler.step(n_updates)
+        log_output = train_step(samples)
         if log_output is None:
             continue
+        n_updates += 1
+
+        # log mid-epoch stats, every --mdl-log-every updates
+        if log_every and n_updates % log_every == 0:
+            log_start = perf_counter()
+            stats = get_training_stats(trainer)
+            progress.log(stats, tag='train', step=stats['num_updates'])
+            log_seconds += perf_counter() - log_start
+            n_logged += 1
+
+        if not check_interval:
+            continue
+
+        window_loss += log_output.get('loss', 0)
+        window_updates += 1
+        if window_updates < check_interval:
+            continue
+
+        mean_loss = window_loss / window_updates
+        window_loss, window_updates = 0., 0
+
+        if args.mdl_stop_loss is not None and mean_loss <= args.mdl_stop_loss:
+            print(f'| stopping after {n_updates} updates: training loss {mean_loss:.3g} <= {args.mdl_stop_loss}')
+            break
+
+        if best_loss is None or mean_loss < best_loss * (1 - args.mdl_plateau_tolerance):
+            best_loss, checks_without_improvement = mean_loss, 0
+        else:
+            checks_without_improvement += 1
 
-        # log mid-epoch stats
-        stats = get_training_stats(trainer)
-        progress.log(stats, tag='train', step=stats['num_updates'])
+        if args.mdl_plateau_patience and checks_without_improvement >= args.mdl_plateau_patience:
+            print(f'| stopping after {n_updates} updates: training loss plateaued at {mean_loss:.3g}')
+            break
 
+    if profiler is not None:
+        profiler.close()
+
+    summary_start = perf_counter()
     stats = get_training_stats(trainer)
     progress.print(stats, tag='train', step=stats['num_updates'])
+    summary_seconds = perf_counter() - summary_start
+
+    if timer is not None:
+        timer.add('logging', log_seconds)
+        if n_logged < n_updates:
+            # estimated from the cost of the updates that were logged or, if none was
+            # (--mdl-log-every=0), from that of the end-of-step summary
+            seconds_per_log = log_seconds / n_logged if n_logged else summary_seconds
+            timer.add('logging_saved', (n_updates - n_logged) * seconds_per_log)
 
     # reset training meters
     for k in ['train_loss', 'train_nll_loss', 'wps', 'ups', 'wpb', 'bsz', 'gnorm', 'clip']:
@@ -198,56 +1279,75 @@ def train(args, trainer, task, epoch_itr):
         if meter is not None:
             meter.reset()
 
+    return n_updates
 
-def validate(args, trainer, task, epoch_itr, subsets, allowed_batches):
-    """Evaluate the model on the validation set(s) and return the losses."""
-
-    assert len(subsets) == 1
-
-    valid_epoch_itr = task.get_batch_iterator(
-        dataset=task.dataset(subsets[0]),
-        max_tokens=args.max_tokens_valid,
-        max_sentences=args.max_sentences_valid,
-        max_positions=utils.resolve_max_positions(
-            task.max_positions(),
-            trainer.get_model().max_positions(),
-        ),
-        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
-        required_batch_size_multiple=args.required_batch_size_multiple,
-        seed=args.seed,
-        num_shards=args.distributed_world_size,
-        shard_id=args.distributed_rank,
-        num_workers=args.num_workers,
-    )
 
-    valid_epoch_itr.frozen_batches = allowed_batches
+def validate(args, trainer, task, subset, block):
+    """Score the examples of `block` of the `subset` dataset (as a single batch, unless --mdl-max-tokens is set) and return the loss
+    and the per-example cross-entropies (see `score_sample`). This always runs in fp32 (outside of --autocast), as it
+    determines the description length."""
 
-    itr = valid_epoch_itr.next_epoch_itr(shuffle=False)
-    progress = progress_bar.build_progress_bar(
-        args, itr, valid_epoch_itr.epoch,
-        prefix='next block validation',
-        no_progress_bar='simple'
-    )
+    dataset = task.dataset(subset)
+    # the block is collated directly, rather than through an iterator over the whole dataset;
+    # with --mdl-max-tokens, it is scored in chunks, whose losses are averaged weighted by
+    # their sample sizes, as for a single batch
+    chunks = split_by_tokens(block, dataset.size, args.mdl_max_tokens) if args.mdl_max_tokens else [block]
+
+    total_loss = total_sample_size = 0.
+    example_losses = []
+    for chunk in chunks:
+        sample = dataset.collater([dataset[i] for i in chunk])
+        if trainer.cuda:
+            sample = utils.move_to_cuda(sample)
+        loss, sample_size, chunk_losses = score_sample(trainer.get_model(), trainer.get_criterion(), sample,
+                                                       task.target_dictionary.pad(), args.sentence_avg)
+        total_loss += loss
+        total_sample_size += sample_size
+        example_losses += chunk_losses
+
+    # in bits, as the valid_loss meter of Trainer.valid_step
+    valid_loss = total_loss / total_sample_size / math.log(2)
+
+    return valid_loss, example_losses
 
-    # reset validation loss meters
-    for k in ['valid_loss', 'valid_nll_loss', 'loss']:
-        meter = trainer.get_meter(k)
-        if meter is not None:
-            meter.reset()
 
-    for sample in progress:
-        log_output = trainer.valid_step(sample)
+def score_sample(model, criterion, sample, pad, sentence_avg):
+    """Score `sample` with a single forward pass and return the criterion's (summed) loss, its sample size, and the
+    (example id, cross-entropy in bits, summed over the target tokens) pairs of the examples."""
+    model.eval()
+    criterion.eval()
+    with torch.no_grad():
+        net_output = model(**sample['net_input'])
+        loss, _ = criterion.compute_loss(model, net_output, sample, reduce=True)
+        lprobs = model.get_normalized_probs(net_output, log_probs=True).float()
+        target = model.get_targets(sample, net_output)
+        nll = -lprobs.gather(dim=-1, index=target.unsqueeze(-1)).squeeze(-1)
+        nll = nll.masked_fill(target.eq(pad), 0.)
+    sample_size = sample['target'].size(0) if sentence_avg else sample['ntokens']
+    bits = (nll.sum(dim=-1) / math.log(2)).tolist()
+    return loss.item(), sample_size, list(zip(sample['id'].tolist(), bits))
 
-    # log validation stats
-    valid_loss = trainer.get_meter('valid_loss').avg
 
-    return valid_loss
+EXAMPLE_CROSS_ENTROPY_DTYPE = np.dtype([('step', np.int32), ('example', np.int32), ('cross_entropy', np.float32)])
+
+def write_example_cross_entropies(path, step_example_losses):
+    """Write the per-example cross-entropies of every transmitted block, i.e. of the examples of block `step + 1` under
+    the model trained at `step`, as a numpy structured array (np.load-able) with fields step, example and cross_entropy."""
+    rows = [(step, example, bits) for step, example_losses in enumerate(step_example_losses)
+            for example, bits in (example_losses or [])]
+    np.save(path, np.array(rows, dtype=EXAMPLE_CROSS_ENTROPY_DTYPE))
 
 
 def cli_main(args):
     parser = options.get_training_parser()
     parser.add_argument("--mdl-block-size", type=int, default=1, 
         help="Size of the transmitted block. Used when calculating description length")
+    parser.add_argument("--mdl-block-schedule", choices=['fixed', 'doubling', 'timestamps'], default='fixed',
+        help="How the hold-out examples are split into blocks: 'fixed' blocks of --mdl-block-size, 'doubling' blocks "
+             "(--mdl-block-size, --mdl-block-size, 2x, 4x, ...), or blocks ending at --mdl-block-timestamps")
+    parser.add_argument("--mdl-block-timestamps", type=str, default=None,
+        help="Comma-separated, increasing numbers of hold-out examples transmitted after each block "
+             "(with --mdl-block-schedule=timestamps), e.g. 1,2,4,8,16")
     parser.add_argument("--mdl-epochs", type=int, default=3000, help="Number of updates in per training")
     parser.add_argument("--mdl-batch-size", type=int, default=None, help="If set, specifies the number of examples sampled (with replacement) "
                 "for each update of the learner. If not specified, all examples available at the step are used.")
@@ -255,18 +1355,120 @@ def cli_main(args):
             help="First `mdl-train-examples`  lines in the training dataset are considered as initial training data (see README).")
     parser.add_argument("--mdl-batches-per-epoch", type=int, default=None,
                         help="How many batches to sample for an epoch. Default is all.")
+    parser.add_argument("--mdl-reset-from-memory", action="store_true",
+                        help="Keep the initial model, optimizer and lr scheduler state in memory and restore it in place "
+                        "at every step, instead of reloading initial.pt from disk.")
+    parser.add_argument("--mdl-independent-steps", action="store_true",
+                        help="Reset the optimizer and lr scheduler to their initial state at every step, instead of keeping "
+                        "the optimizer state of the previous step (as Trainer.load_checkpoint(reset_optimizer=True) does), "
+                        "and sample the batches of step N from a generator seeded with --seed + N instead of the global one. "
+                        "Implied by --mdl-parallel-workers.")
+    parser.add_argument("--mdl-save-initial", action="store_true",
+                        help="Write initial.pt even when --mdl-reset-from-memory is set.")
+    parser.add_argument("--mdl-warm-start", action="store_true",
+                        help="Continue training the previous step's model and optimizer at every step, "
+                        "instead of retraining from the initial state.")
+    parser.add_argument("--mdl-warm-start-epochs", type=int, default=300,
+                        help="Used instead of --mdl-epochs for the steps after the first one when --mdl-warm-start is set: "
+                        "the number of updates per step or, with --mdl-batches-per-epoch, of epochs of that many updates.")
+    parser.add_argument("--mdl-parallel-workers", type=int, default=1,
+                        help="Run the MDL steps in a pool of this many processes, one per GPU (round-robin) "
+                        "or, without GPUs, per group of CPU cores.")
+    parser.add_argument("--mdl-length-buckets", action="store_true",
+                        help="With --mdl-batch-size, group examples of similar source/target length into the same batch "
+                        "(each allowed example is still in exactly one batch per epoch).")
+    parser.add_argument("--mdl-max-tokens", type=int, default=None,
+                        help="Split the training batches and the scored next blocks that are larger than this many padded "
+                        "(source + target) tokens into micro-batches; their gradients are accumulated into a single update.")
+    parser.add_argument("--mdl-lazy-batches", action="store_true",
+                        help="Stream the training batches of each step from a seeded sampler instead of building "
+                        "the list of all (epochs x batches-per-epoch) batches up front.")
+    parser.add_argument("--mdl-cache-batches", action="store_true",
+                        help="Collate every distinct training batch of a step once, keep it on the training device "
+                        "and replay it for every update, instead of going through the data loader each time.")
+    parser.add_argument("--mdl-fast-trainer", action="store_true",
+                        help="Run the updates directly on the model, criterion and optimizer instead of through "
+                        "fairseq's Trainer.train_step (single device, no fp16).")
+    parser.add_argument("--autocast", choices=['bf16', 'fp16'], default=None,
+                        help="Train with mixed precision (torch.autocast) in this dtype; next block cross-entropies "
+                        "are still computed in fp32. fp16 requires --mdl-fast-trainer.")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the model with torch.compile once for the whole job (reused across the MDL steps).")
+    parser.add_argument("--compile-benchmark-updates", type=int, default=10,
+                        help="With --compile, time this many training updates of the first batch in eager and compiled "
+                        "mode to report the speedup; 0 only reports the compile time.")
+    parser.add_argument("--mdl-log-every", type=int, default=1,
+                        help="Collect and log the training stats every this many updates; 0 only logs them at the end of each step. "
+                        "The trainer's meters are still updated at every update (unless --mdl-fast-trainer is set).")
+    parser.add_argument("--mdl-stop-check-interval", type=int, default=0,
+                        help="If set, check for convergence every this many updates, on the mean training loss since the "
+                        "previous check, and stop the step early (see --mdl-stop-loss and --mdl-plateau-patience).")
+    parser.add_argument("--mdl-stop-loss", type=float, default=None,
+                        help="Stop a step once the training loss (in bits, as logged) is at or below this value (perfect fit threshold).")
+    parser.add_argument("--mdl-plateau-patience", type=int, default=0,
+                        help="Stop a step after this many checks without an improvement of the training loss.")
+    parser.add_argument("--mdl-plateau-tolerance", type=float, default=0.01,
+                        help="Minimal relative decrease of the training loss that counts as an improvement.")
+    parser.add_argument("--mdl-resume", action="store_true",
+                        help="Skip the steps already recorded in <save-dir>/mdl-progress.jsonl by an interrupted run.")
+    parser.add_argument("--profile-step", type=int, default=None,
+                        help="Record a profiler trace of the training at this MDL step, written to "
+                        "<save-dir>/profile-step<N>.json (Chrome/Perfetto trace) and .txt (operator summary).")
+    parser.add_argument("--profile-updates", type=str, default=None,
+                        help="Only profile updates A (inclusive) to B (exclusive) of --profile-step, given as A:B.")
+    parser.add_argument("--num-threads", type=int, default=None,
+                        help="Number of intra-op threads used by torch (e.g. with --cpu).")
+    parser.add_argument("--num-interop-threads", type=int, default=None,
+                        help="Number of inter-op threads used by torch (e.g. with --cpu).")
+    parser.add_argument("--mdl-seeds", type=str, default=None,
+                        help="Comma-separated list of seeds. If set, one replica of the model per seed is trained in this "
+                        "process on the same batches (taken from --seed); checkpoints go to <save-dir>/seed<seed>/.")
     args = options.parse_args_and_arch(parser, input_args=args)
 
-    assert torch.cuda.is_available()
+    assert args.cpu or torch.cuda.is_available(), 'CUDA is not available, use --cpu to train on CPU'
+    assert not (args.mdl_fast_trainer and args.fp16), '--mdl-fast-trainer does not support --fp16'
+    assert args.autocast != 'fp16' or (args.mdl_fast_trainer and not args.cpu), \
+        '--autocast=fp16 needs --mdl-fast-trainer (for loss scaling) and CUDA, use --autocast=bf16 otherwise'
+    assert not (args.mdl_max_tokens and args.mdl_seeds), '--mdl-max-tokens is not supported with --mdl-seeds'
+    assert not (args.mdl_warm_start and args.mdl_seeds), '--mdl-warm-start is not supported with --mdl-seeds'
+    assert args.mdl_stop_check_interval or (args.mdl_stop_loss is None and not args.mdl_plateau_patience), \
+        '--mdl-stop-loss and --mdl-plateau-patience need --mdl-stop-check-interval'
+    assert not (args.mdl_stop_check_interval and args.mdl_seeds), \
+        '--mdl-stop-check-interval (--mdl-stop-loss, --mdl-plateau-patience) is not supported with --mdl-seeds'
+    assert not (args.mdl_log_every != 1 and args.mdl_seeds), \
+        '--mdl-log-every is not supported with --mdl-seeds, which does not log training stats'
+    assert not (args.mdl_fast_trainer and args.mdl_seeds), \
+        '--mdl-fast-trainer is not supported with --mdl-seeds, which always runs its own update loop'
+    assert not (args.autocast and args.mdl_seeds), '--autocast is not supported with --mdl-seeds'
+    assert not (args.mdl_resume and args.mdl_seeds), '--mdl-resume is not supported with --mdl-seeds'
+    assert not (args.mdl_parallel_workers > 1 and args.mdl_seeds), '--mdl-parallel-workers is not supported with --mdl-seeds'
+    assert not (args.mdl_save_initial and args.mdl_seeds), \
+        '--mdl-save-initial is not supported with --mdl-seeds, which always resets the replicas from memory'
+    assert not (args.profile_step is not None and args.mdl_seeds), '--profile-step is not supported with --mdl-seeds'
+    assert not (args.mdl_cache_batches and args.mdl_seeds), \
+        '--mdl-cache-batches is not supported with --mdl-seeds, which always collates every distinct batch once per step'
+    if args.profile_updates:
+        assert args.profile_step is not None, '--profile-updates needs --profile-step'
+        bounds = args.profile_updates.split(':')
+        assert len(bounds) == 2 and all(bound.isdigit() for bound in bounds) and int(bounds[0]) < int(bounds[1]), \
+            f'--profile-updates must be A:B with 0 <= A < B, got {args.profile_updates!r}'
+    set_thread_counts(args)
     # assert args.mdl_train_examples
 
     if not args.sentence_avg:
         print('Overriding --sentence-avg', file=sys.stderr)
         args.sentence_avg = True
 
+    if args.mdl_parallel_workers > 1 and not args.mdl_independent_steps:
+        print('Overriding --mdl-independent-steps (steps run in parallel cannot depend on each other)', file=sys.stderr)
+        args.mdl_independent_steps = True
+
     # override multi-gpu logic
     args.distributed_world_size = 1
-    main(args)
+    if args.mdl_seeds:
+        main_multi_seed(args)
+    else:
+        main(args)
 
 if __name__ == '__main__':
     cli_main(sys.argv[1:])